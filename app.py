@@ -5,15 +5,39 @@
 """
 
 import os
+import re
 import json
 import time
 import base64
+import gc
+import logging
+import hashlib
+import math
+import zlib
+from types import MappingProxyType
 import streamlit as st
 import requests
 import asyncio
 import shutil
-from jinja2 import Environment, FileSystemLoader
-from typing import List, Dict, Optional
+import tempfile
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from pathlib import Path
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from typing import List, Dict, Optional, Iterator, Callable
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+
+# orjson заметно быстрее стандартного json; при отсутствии работаем без него
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Импорт функций для работы с изображениями
 try:
@@ -31,22 +55,62 @@ except AttributeError as e:
     st.error("Проверьте целостность файла image_utils.py")
     st.stop()
 
+# Контекст скрипта нужен потокам, которые вызывают функции Streamlit
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:
+    add_script_run_ctx = None
+    get_script_run_ctx = None
+
+# Фрагмент перезапускается отдельно от остального скрипта (Streamlit >= 1.33);
+# на старых версиях декоратор ничего не меняет
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
+
+# Подробности ответов LLM пишутся на уровне DEBUG: без настроенного логирования
+# аргументы не форматируются и в вывод ничего не попадает
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
 # === НАСТРОЙКИ ===
 SETTINGS_FILE = "settings.json"
 CUSTOM_PROMPTS_FILE = "custom_prompts.json"
-HISTORY_FILE = "history.json"
+HISTORY_FILE = "history.jsonl"
+LEGACY_HISTORY_FILE = "history.json"
+HISTORY_LIMIT = 50
+HISTORY_COMPACT_BYTES = 256 * 1024  # После этого размера файл истории ужимается до HISTORY_LIMIT записей
+LLM_CACHE_FILE = "llm_cache.sqlite"
+LEGACY_LLM_CACHE_FILE = "llm_cache.jsonl"
+LLM_CACHE_TTL = 30 * 24 * 3600  # Сколько секунд ответ LLM считается актуальным
+SEMANTIC_CACHE_FILE = "semantic_cache.jsonl"
+SEMANTIC_DIM = 2048  # Размерность хешированного n-граммного вектора
+SEMANTIC_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"  # Модель эмбеддингов, если установлен sentence-transformers
+SEMANTIC_CACHE_LIMIT = 512  # Максимум абзацев в семантическом кэше (вытесняются давно не использованные)
 TEMPLATE_DIR = "templates"
+JINJA_CACHE_DIR = ".jinja_cache"
 HTML_OUT = "output.html"
 IMAGES_DIR = "saved_images"
 USED_IMAGES_DIR = "used_in_davinci"
+PARAGRAPH_WORKERS = 4  # Абзацев, обрабатываемых одновременно
+SEARCH_WORKERS = 8  # Одновременных запросов к поисковикам в одном абзаце
+LLM_HEALTH_TTL = 60  # Сколько секунд считать результат проверки LLM сервера актуальным
+PROCESS_CACHE_TTL = 86400  # Сколько секунд считать готовые результаты обработки абзацев актуальными
+PROCESS_CACHE_LIMIT = 1024  # Максимум готовых результатов абзацев в кэше на диске
+# Настройки, которые не влияют на результат обработки абзаца
+PROCESS_CACHE_IGNORED = ("debug_mode", "llm_api_key", "llm_cache", "semantic_cache", "batch_queries", "stream_queries")
+IMAGE_CHECK_TIMEOUT = 2  # Таймаут проверки ссылки на изображение, секунд
+IMAGE_CHECK_TTL = 3600  # Сколько секунд помнить результат проверки ссылки
+SETTINGS_SAVE_DELAY = 2.0  # Серия изменений настроек за это время пишется на диск один раз
+GC_THRESHOLD = (50_000, 10, 10)  # Порог сборки мусора: реже, чем стандартные 700 объектов
 
 # Создаем необходимые папки
 os.makedirs(IMAGES_DIR, exist_ok=True)
 os.makedirs(USED_IMAGES_DIR, exist_ok=True)
 os.makedirs(TEMPLATE_DIR, exist_ok=True)
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
 
 # === НАСТРОЙКИ ПО УМОЛЧАНИЮ ===
-DEFAULT_SETTINGS = {
+# Только для чтения: случайное изменение словаря по умолчанию вызовет ошибку
+DEFAULT_SETTINGS = MappingProxyType({
     "llm_url": "http://localhost:1234/v1/chat/completions",
     "llm_model": "local-llm",
     "llm_api_key": "",
@@ -54,53 +118,165 @@ DEFAULT_SETTINGS = {
     "search_engine": "duckduckgo",
     "search_language": "auto",
     "url_parsing": True,
+    "validate_images": False,
     "system_prompt": "Создай короткие поисковые запросы (максимум 3 слова каждый) для поиска изображений к тексту. Каждый запрос на новой строке. Отвечай ТОЛЬКО ключевыми словами без объяснений.",
     "split_long_paragraphs": False,
     "smart_queries": True,
+    "batch_queries": True,
+    "stream_queries": True,
+    "llm_cache": True,
+    "semantic_cache": True,
+    "semantic_threshold": 0.92,
     "searxng_url": "http://localhost:8080",
     "searxng_count": 6,
     "duckduckgo_count": 3,
     "pixabay_count": 3,
     "pinterest_count": 3,
     "tenor_count": 3
-}
+})
+
+# Регулярные выражения для очистки ответов LLM (компилируются один раз)
+THINK_BLOCK_RE = re.compile(r'<think>.*?</think>', re.DOTALL)
+THINK_PREFIX_RE = re.compile(r'^[/]?think\s*', re.IGNORECASE)
+XML_TAG_RE = re.compile(r'<[^>]+>')
+LIST_MARKER_RE = re.compile(r'^[\d\.\-\•\*\s]+')
+EXPLANATION_LINE_RE = re.compile(r'^(?:Вот|Для|Я создал|Создал|Анализ|Текст|Поисковые запросы|Запросы|Хм,|Пользователь|Абзац \d+)')
+# Разделитель блоков запросов при пакетной генерации
+BATCH_DELIMITER = "###"
+LLM_BATCH_SIZE = 6  # Абзацев в одном пакетном запросе: больше - модель чаще сбивается с формата
+SMART_QUERY_PROMPT = "Текст для анализа:\n{paragraph}\n\nСоздай короткие поисковые запросы для изображений к этому тексту."
+
+# Разбиение текста на абзацы и предложения
+# Пустая строка может содержать пробелы или \r (текст из файлов Windows)
+PARAGRAPH_SPLIT_RE = re.compile(r'\n\s*\n')
+SENTENCE_BOUNDARY_RE = re.compile(r'(?<=[.!?])\s+')
+LONG_PARAGRAPH_LIMIT = 500
+
+# Быстрая проверка, есть ли в абзаце ссылки (большинство абзацев без них)
+URL_RE = re.compile(r'https?://[^\s<>"\']+')
+# До трех первых слов абзаца без разбиения всего текста
+FIRST_WORDS_RE = re.compile(r'\s*(\S+)(?:\s+(\S+))?(?:\s+(\S+))?')
 
 DEFAULT_PROMPTS = {
     "ЗАПРОСОВ ДЛЯ ИЗОБРАЖЕНИЙ": "🔍 ТЫ — ЭКСПЕРТ ПО СОЗДАНИЮ ПОИСКОВЫХ ЗАПРОСОВ ДЛЯ ИЗОБРАЖЕНИЙ\n\n🎯 ЗАДАЧА:\nПрочитай текст. Найди в нём отдельные темы и создай по одной поисковый запрос для каждой.\nТвоя цель — визуализировать каждую тему: подумай, что именно должно быть на изображении, и преврати это в чёткий, короткий запрос.\n\n🧠 КАК ДУМАТЬ О КАЖДОЙ ТЕМЕ:\nПеред тем как создать запрос, проанализируй тему с помощью этих вопросов:\n    Что именно происходит?\n    Кто или что участвует?\n    Где и в каком контексте?\n\n✅ ПРАВИЛА СОЗДАНИЯ ЗАПРОСОВ:\n- Максимум 5 слов в одном запросе\n- Каждый запрос на отдельной строке\n- Конкретные объекты, а не абстракции\n- Визуально представимые понятия\n- БЕЗ нумерации, БЕЗ кавычек, БЕЗ объяснений\n\n🎯 ЦЕЛЬ: Создать 3-8 запросов, каждый из которых поможет найти изображение, иллюстрирующее конкретную тему из текста.",
     "Простая система": "Создай короткие поисковые запросы для изображений к тексту. Каждый запрос максимум 3 слова, каждый на новой строке."
 }
 
+# === СЕРИАЛИЗАЦИЯ JSON ===
+def json_loads(data):
+    """Разбор JSON из байтов или строки (orjson или стандартный json)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj, indent: bool = False) -> bytes:
+    """Сериализация в UTF-8 байты без экранирования кириллицы"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode('utf-8')
+
+def atomic_write(path: str, data: bytes) -> None:
+    """
+    Запись через временный файл и os.replace: при прерывании на диске
+    остается старая версия, а не обрезанный JSON. Имя временного файла
+    уникально, поэтому одновременные записи одного файла не смешиваются
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                    prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Недописанный временный файл не оставляем
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# === ЧТЕНИЕ ФАЙЛОВ С КЭШИРОВАНИЕМ ===
+def file_signature(path: str) -> Optional[tuple]:
+    """Отпечаток файла (время изменения и размер) или None, если файла нет"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def read_json_file(path: str, signature: tuple):
+    """
+    Разбор JSON файла. Кэш Streamlit переживает перезапуски скрипта,
+    а отпечаток файла в аргументах сбрасывает его при изменении файла
+    """
+    with open(path, 'rb') as f:
+        return json_loads(f.read())
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def read_jsonl_tail(path: str, signature: tuple, limit: int) -> List[Dict]:
+    """Последние limit записей JSONL файла, новые первыми"""
+    with open(path, 'rb') as f:
+        # Читаем поток строк, сохраняя только хвост файла
+        tail = deque(f, maxlen=limit)
+    
+    entries = []
+    for line in reversed(tail):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entries.append(json_loads(line))
+        except ValueError:
+            # Пропускаем строку, оборванную при аварийной записи
+            continue
+    return entries
+
 # === ФУНКЦИИ РАБОТЫ С НАСТРОЙКАМИ ===
 def load_settings() -> Dict:
     """Загрузка настроек из файла"""
     try:
-        if os.path.exists(SETTINGS_FILE):
-            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-                settings = json.load(f)
-                # Добавляем отсутствующие настройки
-                for key, value in DEFAULT_SETTINGS.items():
-                    if key not in settings:
-                        settings[key] = value
-                return settings
+        signature = file_signature(SETTINGS_FILE)
+        if signature:
+            # Отсутствующие настройки берутся из значений по умолчанию
+            return {**DEFAULT_SETTINGS, **read_json_file(SETTINGS_FILE, signature)}
     except Exception as e:
         st.error(f"Ошибка загрузки настроек: {e}")
     
-    return DEFAULT_SETTINGS.copy()
+    return dict(DEFAULT_SETTINGS)
 
 def save_settings(settings: Dict) -> None:
     """Сохранение настроек в файл"""
     try:
-        with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(settings, f, ensure_ascii=False, indent=2)
+        atomic_write(SETTINGS_FILE, json_dumps(settings, indent=True))
     except Exception as e:
         st.error(f"Ошибка сохранения настроек: {e}")
 
+def schedule_settings_save(settings: Dict) -> None:
+    """
+    Отложенное сохранение настроек: каждое изменение перезапускает таймер,
+    файл записывается после паузы в SETTINGS_SAVE_DELAY секунд
+    """
+    timer = st.session_state.get("settings_save_timer")
+    if timer is not None:
+        timer.cancel()
+    
+    timer = threading.Timer(SETTINGS_SAVE_DELAY, save_settings, args=(dict(settings),))
+    timer.daemon = True
+    if add_script_run_ctx is not None:
+        add_script_run_ctx(timer)
+    timer.start()
+    st.session_state.settings_save_timer = timer
+
 def load_custom_prompts() -> Dict:
     """Загрузка пользовательских промптов"""
     try:
-        if os.path.exists(CUSTOM_PROMPTS_FILE):
-            with open(CUSTOM_PROMPTS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+        signature = file_signature(CUSTOM_PROMPTS_FILE)
+        if signature:
+            return read_json_file(CUSTOM_PROMPTS_FILE, signature)
     except Exception as e:
         st.error(f"Ошибка загрузки промптов: {e}")
     
@@ -109,28 +285,58 @@ def load_custom_prompts() -> Dict:
 def save_custom_prompts(prompts: Dict) -> None:
     """Сохранение пользовательских промптов"""
     try:
-        with open(CUSTOM_PROMPTS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(prompts, f, ensure_ascii=False, indent=2)
+        atomic_write(CUSTOM_PROMPTS_FILE, json_dumps(prompts, indent=True))
     except Exception as e:
         st.error(f"Ошибка сохранения промптов: {e}")
 
+@contextmanager
+def edit_prompts():
+    """
+    Группирует изменения промптов: загрузка один раз,
+    запись на диск только если словарь действительно изменился
+    """
+    prompts = load_custom_prompts()
+    original = json_dumps(prompts)
+    yield prompts
+    if json_dumps(prompts) != original:
+        save_custom_prompts(prompts)
+
 # === ФУНКЦИИ РАБОТЫ С ИСТОРИЕЙ ===
+def migrate_legacy_history() -> None:
+    """Перенос истории из старого history.json в history.jsonl"""
+    if os.path.exists(HISTORY_FILE) or not os.path.exists(LEGACY_HISTORY_FILE):
+        return
+    
+    with open(LEGACY_HISTORY_FILE, 'rb') as f:
+        legacy = json_loads(f.read())
+    
+    # В старом формате новые записи были в начале списка
+    atomic_write(HISTORY_FILE, b"".join(
+        json_dumps(entry) + b"\n" for entry in reversed(legacy[:HISTORY_LIMIT])
+    ))
+    os.remove(LEGACY_HISTORY_FILE)
+
 def load_history() -> List[Dict]:
-    """Загрузка истории обработки"""
+    """Загрузка истории обработки (новые записи первыми)"""
     try:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+        migrate_legacy_history()
+        signature = file_signature(HISTORY_FILE)
+        if signature:
+            return read_jsonl_tail(HISTORY_FILE, signature, HISTORY_LIMIT)
     except Exception as e:
         st.error(f"Ошибка загрузки истории: {e}")
     
     return []
 
+def compact_history() -> None:
+    """Перезапись файла истории только последними HISTORY_LIMIT записями"""
+    with open(HISTORY_FILE, 'rb') as f:
+        tail = deque(f, maxlen=HISTORY_LIMIT)
+    atomic_write(HISTORY_FILE, b"".join(tail))
+
 def save_to_history(text: str, paragraphs_count: int, images_count: int, search_engine: str, language: str) -> None:
     """Сохранение записи в историю"""
     try:
-        history = load_history()
-        
         # Создаем новую запись
         entry = {
             "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
@@ -141,43 +347,348 @@ def save_to_history(text: str, paragraphs_count: int, images_count: int, search_
             "language": language
         }
         
-        # Добавляем в начало списка
-        history.insert(0, entry)
-        
-        # Ограничиваем историю 50 записями
-        history = history[:50]
+        # Дописываем одну строку без чтения и перезаписи всего файла
+        with open(HISTORY_FILE, 'ab') as f:
+            f.write(json_dumps(entry) + b"\n")
         
-        # Сохраняем
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
+        # Изредка ужимаем файл, чтобы он не рос бесконечно
+        if os.path.getsize(HISTORY_FILE) > HISTORY_COMPACT_BYTES:
+            compact_history()
             
     except Exception as e:
         st.error(f"Ошибка сохранения в историю: {e}")
 
+# === КЭШ ОТВЕТОВ LLM ===
+@st.cache_resource
+def get_llm_cache() -> Dict:
+    """
+    Кэш ответов LLM в SQLite. Соединение открывается один раз за процесс
+    и используется из потоков обработки абзацев под общей блокировкой
+    """
+    conn = sqlite3.connect(LLM_CACHE_FILE, check_same_thread=False)
+    # WAL: чтение не ждет записи, запись не блокирует интерфейс
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS cache ("
+        "key TEXT PRIMARY KEY, response TEXT NOT NULL, ts INTEGER NOT NULL)"
+    )
+    # Готовые результаты обработки абзацев (см. lookup_paragraph_cache)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS paragraphs ("
+        "key TEXT PRIMARY KEY, result TEXT NOT NULL, ts INTEGER NOT NULL)"
+    )
+    cache = {"conn": conn, "lock": threading.Lock(), "stats": {"hits": 0, "misses": 0}}
+    
+    try:
+        migrate_legacy_llm_cache(conn)
+    except Exception as e:
+        print(f"Ошибка переноса старого кэша LLM: {e}")
+    
+    return cache
+
+def migrate_legacy_llm_cache(conn: sqlite3.Connection) -> None:
+    """Перенос ответов из старого llm_cache.jsonl в SQLite"""
+    if not os.path.exists(LEGACY_LLM_CACHE_FILE):
+        return
+    
+    rows = []
+    now = int(time.time())
+    with open(LEGACY_LLM_CACHE_FILE, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rows.extend((key, content, now) for key, content in json_loads(line).items())
+            except ValueError:
+                # Пропускаем строку, оборванную при аварийной записи
+                continue
+    
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO cache (key, response, ts) VALUES (?, ?, ?)", rows)
+    os.remove(LEGACY_LLM_CACHE_FILE)
+
+def lookup_llm_cache(key: str, count_stats: bool = True) -> Optional[str]:
+    """Ответ LLM из кэша или None, если его нет или он старше LLM_CACHE_TTL"""
+    try:
+        cache = get_llm_cache()
+        with cache["lock"]:
+            row = cache["conn"].execute(
+                "SELECT response FROM cache WHERE key = ? AND ts > ?",
+                (key, int(time.time()) - LLM_CACHE_TTL)
+            ).fetchone()
+    except sqlite3.Error as e:
+        # Недоступный кэш не должен ломать запросы к LLM
+        print(f"Ошибка чтения кэша LLM: {e}")
+        return None
+    
+    if count_stats:
+        cache["stats"]["hits" if row else "misses"] += 1
+    return row[0] if row else None
+
+def llm_cache_key(llm_url: str, model: str, system: str, prompt: str,
+                  max_tokens: int = 200, temperature: float = 0.7) -> str:
+    """
+    Детерминированный ключ кэша для запроса к LLM. Сервер и max_tokens входят в ключ:
+    одноименные модели разных серверов отвечают по-разному, а ответ,
+    обрезанный меньшим лимитом, не подходит запросу с большим
+    """
+    payload = json.dumps({"u": llm_url.rstrip('/'), "m": model, "s": system, "p": prompt,
+                          "n": max_tokens, "t": temperature},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def store_llm_cache(key: str, content: str) -> None:
+    """Сохранение ответа LLM в кэш (одна транзакция на запись)"""
+    if not key or not content:
+        return
+    
+    try:
+        cache = get_llm_cache()
+        with cache["lock"], cache["conn"]:
+            cache["conn"].execute(
+                "INSERT OR REPLACE INTO cache (key, response, ts) VALUES (?, ?, ?)",
+                (key, content, int(time.time()))
+            )
+    except sqlite3.Error as e:
+        print(f"Ошибка записи кэша LLM: {e}")
+
+# === СЕМАНТИЧЕСКИЙ КЭШ ЗАПРОСОВ ===
+@st.cache_resource(show_spinner=False)
+def get_sentence_encoder():
+    """
+    Многоязычная модель эмбеддингов (загружается один раз за процесс).
+    None, если пакет sentence-transformers не установлен или модель не загрузилась
+    """
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError:
+        return None
+    
+    try:
+        return SentenceTransformer(SEMANTIC_MODEL)
+    except Exception as e:
+        print(f"⚠️ Модель эмбеддингов {SEMANTIC_MODEL} недоступна, используем триграммы: {e}")
+        return None
+
+@st.cache_resource
+def warm_up_sentence_encoder() -> threading.Thread:
+    """
+    Один раз на процесс: загружаем модель эмбеддингов в фоне, пока пользователь
+    вводит текст. Первый абзац дождется загрузки внутри get_sentence_encoder
+    """
+    thread = threading.Thread(target=get_sentence_encoder, name="encoder-warmup", daemon=True)
+    if add_script_run_ctx is not None:
+        add_script_run_ctx(thread)
+    thread.start()
+    return thread
+
+def embed_text(text: str) -> Dict[int, float]:
+    """
+    Нормированный вектор абзаца: эмбеддинг модели, если она доступна,
+    иначе разреженный вектор символьных триграмм
+    """
+    encoder = get_sentence_encoder()
+    if encoder is not None:
+        embedding = encoder.encode(text, normalize_embeddings=True)
+        return {i: float(v) for i, v in enumerate(embedding)}
+    return embed_trigrams(text)
+
+def embed_trigrams(text: str) -> Dict[int, float]:
+    """
+    Нормированный разреженный вектор символьных триграмм текста.
+    Используется crc32, т.к. встроенный hash() меняется между запусками
+    """
+    normalized = " ".join(text.lower().split())
+    vector = {}
+    for i in range(len(normalized) - 2):
+        bucket = zlib.crc32(normalized[i:i + 3].encode('utf-8')) % SEMANTIC_DIM
+        vector[bucket] = vector.get(bucket, 0.0) + 1.0
+    
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    if norm:
+        vector = {k: v / norm for k, v in vector.items()}
+    return vector
+
+def cosine_similarity(a: Dict[int, float], b: Dict[int, float]) -> float:
+    """Косинусное сходство нормированных разреженных векторов"""
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0.0) for k, v in a.items())
+
+def semantic_context(settings: Dict) -> str:
+    """
+    Запросы зависят от модели и промпта, поэтому кэш делится по ним.
+    Векторы разных эмбеддеров несравнимы, поэтому учитывается и эмбеддер
+    """
+    embedder = SEMANTIC_MODEL if get_sentence_encoder() is not None else "trigram"
+    payload = f"{settings.get('llm_model', '')}|{settings.get('system_prompt', '')}|{embedder}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+@st.cache_resource
+def get_semantic_cache() -> Dict:
+    """
+    Семантический кэш (загружается с диска один раз за процесс).
+    entries упорядочены от давно использованных к недавним, lock защищает
+    их от одновременного изменения из потоков обработки абзацев
+    """
+    cache = {"entries": deque(maxlen=SEMANTIC_CACHE_LIMIT), "lock": threading.Lock(), "file_lines": 0}
+    try:
+        if os.path.exists(SEMANTIC_CACHE_FILE):
+            with open(SEMANTIC_CACHE_FILE, 'rb') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    cache["file_lines"] += 1
+                    try:
+                        entry = json_loads(line)
+                        entry["vector"] = {int(k): v for k, v in entry["vector"].items()}
+                        entry.setdefault("ts", 0.0)
+                        cache["entries"].append(entry)
+                    except (ValueError, KeyError):
+                        continue
+    except Exception as e:
+        print(f"Ошибка загрузки семантического кэша: {e}")
+    
+    return cache
+
+def lookup_semantic_cache(vector: Dict[int, float], context: str, threshold: float) -> Optional[List[str]]:
+    """Поиск ближайшего абзаца с тем же контекстом; None если сходство ниже порога"""
+    cache = get_semantic_cache()
+    with cache["lock"]:
+        best_score = 0.0
+        best_entry = None
+        for entry in cache["entries"]:
+            if entry["context"] != context:
+                continue
+            score = cosine_similarity(vector, entry["vector"])
+            if score > best_score:
+                best_score = score
+                best_entry = entry
+        
+        if best_entry is None or best_score < threshold:
+            return None
+        
+        # Использованная запись становится самой свежей и вытесняется последней
+        best_entry["ts"] = time.time()
+        cache["entries"].remove(best_entry)
+        cache["entries"].append(best_entry)
+        return list(best_entry["queries"])
+
+def store_semantic_cache(vector: Dict[int, float], context: str, queries: List[str]) -> None:
+    """Добавление абзаца в семантический кэш (дозапись в JSONL)"""
+    if not vector or not queries:
+        return
+    
+    entry = {"context": context, "vector": vector, "queries": list(queries), "ts": time.time()}
+    cache = get_semantic_cache()
+    with cache["lock"]:
+        cache["entries"].append(entry)
+        try:
+            if cache["file_lines"] >= 2 * SEMANTIC_CACHE_LIMIT:
+                # Файл ужимается до записей, которые остались в памяти
+                atomic_write(SEMANTIC_CACHE_FILE, b"".join(json_dumps(e) + b"\n" for e in cache["entries"]))
+                cache["file_lines"] = len(cache["entries"])
+            else:
+                with open(SEMANTIC_CACHE_FILE, 'ab') as f:
+                    f.write(json_dumps(entry) + b"\n")
+                cache["file_lines"] += 1
+        except Exception as e:
+            print(f"Ошибка записи семантического кэша: {e}")
+
 # === ФУНКЦИИ РАБОТЫ С LLM ===
+@st.cache_resource
+def get_llm_session() -> requests.Session:
+    """
+    Общая сессия для запросов к LLM и Gemini: соединения (и TLS) переиспользуются
+    между вызовами. POST по статусу не повторяется - urllib3 повторяет только идемпотентные методы
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=2,
+            backoff_factor=0.3,
+            status_forcelist=[429, 502, 503, 504],
+            raise_on_status=False
+        )
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+CHAT_COMPLETIONS_PATH = '/v1/chat/completions'
+
+@dataclass(frozen=True)
+class LLMEndpoint:
+    """Адреса и заголовки LLM сервера, вычисленные один раз для URL из настроек"""
+    chat_url: str
+    models_url: str
+    base_url: str
+    is_gemini: bool
+    headers: MappingProxyType
+
+@st.cache_resource(max_entries=4, show_spinner=False)
+def llm_endpoint(llm_url: str, api_key: Optional[str] = None) -> LLMEndpoint:
+    """
+    Разбор URL из настроек: исправление пути и заголовки авторизации.
+    Кэш процесса, а не модуля: глобальные объекты app.py создаются заново при каждом перезапуске
+    """
+    # Специальная обработка для Gemini API
+    is_gemini = 'googleapis.com' in llm_url or 'gemini' in llm_url.lower()
+    
+    # Проверяем и исправляем URL (без завершающего '/', иначе путь добавится второй раз)
+    llm_url = llm_url.rstrip('/')
+    if llm_url.endswith(CHAT_COMPLETIONS_PATH):
+        chat_url = llm_url
+    else:
+        chat_url = llm_url + CHAT_COMPLETIONS_PATH
+    base_url = chat_url[:-len(CHAT_COMPLETIONS_PATH)].rstrip('/')
+    models_url = llm_url if llm_url.endswith('/v1/models') else f"{base_url}/v1/models"
+    
+    headers = {'Content-Type': 'application/json'}
+    if api_key:
+        headers['Authorization'] = f'Bearer {api_key}'
+    
+    return LLMEndpoint(chat_url, models_url, base_url, is_gemini, MappingProxyType(headers))
+
+@st.cache_resource
+def get_llm_health() -> Dict:
+    """Последний результат проверки доступности LLM сервера"""
+    return {"url": None, "ok": False, "expires": 0.0}
+
+def check_llm_server(base_url: str, headers: Dict) -> bool:
+    """Проверка доступности LLM сервера с кэшированием на LLM_HEALTH_TTL секунд"""
+    health = get_llm_health()
+    if health["url"] == base_url and time.time() < health["expires"]:
+        return health["ok"]
+    
+    session = get_llm_session()
+    ok = False
+    for path in ("/health", "/v1/models"):
+        try:
+            session.get(f"{base_url}{path}", headers=headers, timeout=5)
+            ok = True
+            break
+        except requests.exceptions.RequestException:
+            continue
+    
+    health.update({"url": base_url, "ok": ok, "expires": time.time() + LLM_HEALTH_TTL})
+    return ok
+
 def get_available_models(llm_url: str, api_key: str = None) -> List[str]:
     """Получение списка доступных моделей через API"""
     try:
-        # Специальная обработка для Gemini API
-        if ('generativelanguage.googleapis.com' in llm_url or 
-            'googleapis.com' in llm_url or 
-            'gemini' in llm_url.lower()):
+        endpoint = llm_endpoint(llm_url, api_key)
+        if endpoint.is_gemini:
             return get_gemini_models(api_key)
         
-        # Проверяем и исправляем URL
-        if not llm_url.endswith('/v1/models'):
-            base_url = llm_url.replace('/v1/chat/completions', '').rstrip('/')
-            models_url = f"{base_url}/v1/models"
-        else:
-            models_url = llm_url
-        
-        headers = {'Content-Type': 'application/json'}
-        if api_key:
-            headers['Authorization'] = f'Bearer {api_key}'
+        logger.debug("🔍 Проверяем доступные модели: %s", endpoint.models_url)
         
-        print(f"🔍 Проверяем доступные модели: {models_url}")
-        
-        response = requests.get(models_url, headers=headers, timeout=10)
+        response = get_llm_session().get(endpoint.models_url, headers=endpoint.headers, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -205,7 +716,7 @@ def get_available_models(llm_url: str, api_key: str = None) -> List[str]:
                     filtered_models.append(model.strip())
             
             filtered_models.sort()
-            print(f"✅ Найдено {len(filtered_models)} моделей")
+            logger.debug("✅ Найдено %d моделей", len(filtered_models))
             return filtered_models
             
         else:
@@ -232,9 +743,9 @@ def get_gemini_models(api_key: str = None) -> List[str]:
         # URL для получения списка моделей Gemini
         models_url = f"https://generativelanguage.googleapis.com/v1beta/models?key={api_key}"
         
-        print(f"🔍 Проверяем модели Gemini API...")
+        logger.debug("🔍 Проверяем модели Gemini API...")
         
-        response = requests.get(models_url, timeout=10)
+        response = get_llm_session().get(models_url, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -255,7 +766,7 @@ def get_gemini_models(api_key: str = None) -> List[str]:
                             models.append(model_name)
             
             models.sort()
-            print(f"✅ Найдено {len(models)} моделей Gemini")
+            logger.debug("✅ Найдено %d моделей Gemini", len(models))
             return models
             
         elif response.status_code == 400:
@@ -278,7 +789,101 @@ def get_gemini_models(api_key: str = None) -> List[str]:
         print(f"❌ Ошибка получения моделей Gemini: {e}")
         return []
 
-def ask_gemini(prompt: str, system: str, model: str, api_key: str = None) -> str:
+# Служебные поля и слова, которые не считаются текстом ответа
+GEMINI_PRIORITY_KEYS = ('text', 'content', 'message', 'response')
+GEMINI_SKIPPED_KEYS = ('usageMetadata', 'modelVersion', 'responseId', 'finishReason', 'index')
+GEMINI_SERVICE_WORDS = ('model', 'version', 'id', 'metadata', 'usage')
+
+def find_text_in_tree(root, fallback: bool = False) -> Optional[str]:
+    """
+    Поиск текста в структуре ответа Gemini обходом в глубину с явным стеком.
+    Обычный режим: первое непустое поле text или строка длиннее 10 символов.
+    Режим fallback: сначала приоритетные поля, служебные поля и строки пропускаются
+    """
+    # Элементы стека: (объект, является ли он значением поля text)
+    stack = [(root, False)]
+    while stack:
+        obj, is_text_field = stack.pop()
+        if isinstance(obj, str):
+            text = obj.strip()
+            if fallback:
+                if len(text) > 10 and not any(word in obj.lower() for word in GEMINI_SERVICE_WORDS):
+                    return text
+            elif (is_text_field and text) or len(text) > 10:
+                return text
+        elif isinstance(obj, dict):
+            if fallback:
+                children = [(value, False) for key, value in obj.items() if key in GEMINI_PRIORITY_KEYS]
+                children += [(value, False) for key, value in obj.items()
+                             if key not in GEMINI_PRIORITY_KEYS and key not in GEMINI_SKIPPED_KEYS]
+            else:
+                children = [(value, key == 'text') for key, value in obj.items()]
+            # Обратный порядок сохраняет обход полей слева направо
+            stack.extend(reversed(children))
+        elif isinstance(obj, list):
+            stack.extend((item, False) for item in reversed(obj))
+    return None
+
+def gemini_text_from_parts(content) -> Optional[str]:
+    """Стандартная структура с parts"""
+    if isinstance(content, dict) and isinstance(content.get('parts'), list):
+        parts = content['parts']
+        if parts and isinstance(parts[0], dict) and isinstance(parts[0].get('text'), str):
+            return parts[0]['text'].strip()
+    return None
+
+def gemini_text_field(content) -> Optional[str]:
+    """Прямой текст в content"""
+    if isinstance(content, dict) and isinstance(content.get('text'), str):
+        return content['text'].strip()
+    return None
+
+def gemini_text_string(content) -> Optional[str]:
+    """Content как строка"""
+    if isinstance(content, str):
+        return content.strip()
+    return None
+
+def gemini_text_tree(content) -> Optional[str]:
+    """Новая структура Gemini 2.5 - обход всех полей"""
+    if isinstance(content, dict):
+        return find_text_in_tree(content)
+    return None
+
+# Способы извлечения текста из content в порядке проверки
+GEMINI_CONTENT_PARSERS = {
+    "parts": gemini_text_from_parts,
+    "content.text": gemini_text_field,
+    "строка": gemini_text_string,
+    "структура": gemini_text_tree,
+}
+
+@st.cache_resource
+def get_gemini_schemas() -> Dict[str, str]:
+    """Модель Gemini -> способ извлечения текста, сработавший в прошлый раз"""
+    return {}
+
+def extract_gemini_content(content, model: str) -> Optional[str]:
+    """
+    Текст из content ответа Gemini. Формат ответа у модели постоянный,
+    поэтому сначала пробуем способ, сработавший для нее в прошлый раз
+    """
+    schemas = get_gemini_schemas()
+    known = schemas.get(model)
+    order = list(GEMINI_CONTENT_PARSERS)
+    if known in GEMINI_CONTENT_PARSERS:
+        order.remove(known)
+        order.insert(0, known)
+    
+    for schema in order:
+        response_text = GEMINI_CONTENT_PARSERS[schema](content)
+        if response_text:
+            schemas[model] = schema
+            logger.debug("✅ Получен ответ Gemini (%s): %.100s...", schema, response_text)
+            return response_text
+    return None
+
+def ask_gemini(prompt: str, system: str, model: str, api_key: str = None, max_tokens: int = 200) -> str:
     """Запрос к Gemini API"""
     try:
         if not api_key:
@@ -305,7 +910,7 @@ def ask_gemini(prompt: str, system: str, model: str, api_key: str = None) -> str
             }],
             "generationConfig": {
                 "temperature": 0.7,
-                "maxOutputTokens": 200,
+                "maxOutputTokens": max_tokens,
                 "topP": 0.8,
                 "topK": 10
             }
@@ -313,21 +918,21 @@ def ask_gemini(prompt: str, system: str, model: str, api_key: str = None) -> str
         
         headers = {'Content-Type': 'application/json'}
         
-        response = requests.post(url, json=data, headers=headers, timeout=30)
+        response = get_llm_session().post(url, json=data, headers=headers, timeout=30)
         
         if response.status_code == 200:
             result = response.json()
             
             # Отладочная информация
-            print(f"🔍 Структура ответа Gemini: {list(result.keys())}")
+            logger.debug("🔍 Структура ответа Gemini: %s", list(result))
             if 'usageMetadata' in result:
                 usage = result['usageMetadata']
-                print(f"📊 Использование токенов: {usage}")
+                logger.debug("📊 Использование токенов: %s", usage)
             
             # Извлекаем ответ из структуры Gemini
             if 'candidates' in result and len(result['candidates']) > 0:
                 candidate = result['candidates'][0]
-                print(f"🔍 Структура candidate: {list(candidate.keys())}")
+                logger.debug("🔍 Структура candidate: %s", list(candidate))
                 
                 # Проверяем причину блокировки
                 if 'finishReason' in candidate:
@@ -346,53 +951,11 @@ def ask_gemini(prompt: str, system: str, model: str, api_key: str = None) -> str
                 
                 if 'content' in candidate:
                     content = candidate['content']
-                    print(f"🔍 Структура content: {list(content.keys()) if isinstance(content, dict) else type(content)}")
-                    
-                    # Стандартная структура с parts
-                    if isinstance(content, dict) and 'parts' in content and isinstance(content['parts'], list):
-                        parts = content['parts']
-                        if len(parts) > 0 and isinstance(parts[0], dict) and 'text' in parts[0]:
-                            response_text = parts[0]['text'].strip()
-                            print(f"✅ Получен ответ Gemini (parts): {response_text[:100]}...")
-                            return response_text
+                    logger.debug("🔍 Структура content: %s", list(content) if isinstance(content, dict) else type(content))
                     
-                    # Прямой текст в content
-                    elif isinstance(content, dict) and 'text' in content:
-                        response_text = content['text'].strip()
-                        print(f"✅ Получен ответ Gemini (content.text): {response_text[:100]}...")
+                    response_text = extract_gemini_content(content, model)
+                    if response_text:
                         return response_text
-                    
-                    # Content как строка
-                    elif isinstance(content, str) and content.strip():
-                        print(f"✅ Получен ответ Gemini (строка): {content[:100]}...")
-                        return content.strip()
-                    
-                    # Новая структура Gemini 2.5 - проверяем все поля рекурсивно
-                    elif isinstance(content, dict):
-                        print(f"🔍 Полная структура content: {content}")
-                        
-                        def extract_text_recursive(obj, path=""):
-                            """Рекурсивно ищем текст в структуре"""
-                            if isinstance(obj, str) and len(obj.strip()) > 10:
-                                return obj.strip()
-                            elif isinstance(obj, dict):
-                                for key, value in obj.items():
-                                    if key == 'text' and isinstance(value, str) and value.strip():
-                                        return value.strip()
-                                    result = extract_text_recursive(value, f"{path}.{key}")
-                                    if result:
-                                        return result
-                            elif isinstance(obj, list):
-                                for i, item in enumerate(obj):
-                                    result = extract_text_recursive(item, f"{path}[{i}]")
-                                    if result:
-                                        return result
-                            return None
-                        
-                        extracted_text = extract_text_recursive(content)
-                        if extracted_text:
-                            print(f"✅ Найден текст в структуре: {extracted_text[:100]}...")
-                            return extracted_text
                 else:
                     print("⚠️ Candidate не содержит content - возможно заблокирован")
             else:
@@ -401,42 +964,17 @@ def ask_gemini(prompt: str, system: str, model: str, api_key: str = None) -> str
             # Проверяем альтернативные структуры в корне ответа
             if 'text' in result:
                 response_text = result['text'].strip()
-                print(f"✅ Получен ответ Gemini (прямой text): {response_text[:100]}...")
+                logger.debug("✅ Получен ответ Gemini (прямой text): %.100s...", response_text)
                 return response_text
             
             # Последняя попытка - ищем любой текст в структуре
-            def find_any_text(obj, path="root"):
-                """Ищем любой осмысленный текст в структуре ответа"""
-                if isinstance(obj, str) and len(obj.strip()) > 10:
-                    # Проверяем, что это не служебная информация
-                    if not any(keyword in obj.lower() for keyword in ['model', 'version', 'id', 'metadata', 'usage']):
-                        return obj.strip()
-                elif isinstance(obj, dict):
-                    for key, value in obj.items():
-                        if key in ['text', 'content', 'message', 'response']:
-                            result = find_any_text(value, f"{path}.{key}")
-                            if result:
-                                return result
-                    # Если не нашли в приоритетных полях, ищем везде
-                    for key, value in obj.items():
-                        if key not in ['usageMetadata', 'modelVersion', 'responseId', 'finishReason', 'index']:
-                            result = find_any_text(value, f"{path}.{key}")
-                            if result:
-                                return result
-                elif isinstance(obj, list):
-                    for i, item in enumerate(obj):
-                        result = find_any_text(item, f"{path}[{i}]")
-                        if result:
-                            return result
-                return None
-            
-            fallback_text = find_any_text(result)
+            fallback_text = find_text_in_tree(result, fallback=True)
             if fallback_text:
-                print(f"✅ Найден текст в структуре ответа: {fallback_text[:100]}...")
+                logger.debug("✅ Найден текст в структуре ответа: %.100s...", fallback_text)
                 return fallback_text
             
             print(f"❌ Не удалось извлечь текст из ответа Gemini")
-            print(f"🔍 Полная структура для отладки: {result}")
+            logger.debug("🔍 Полная структура для отладки: %s", result)
             return ""
             
         elif response.status_code == 400:
@@ -462,32 +1000,51 @@ def ask_gemini(prompt: str, system: str, model: str, api_key: str = None) -> str
         print(f"❌ Ошибка запроса к Gemini: {e}")
         return ""
 
-def ask_llm(prompt: str, system: str, llm_url: str, model: str, api_key: str = None) -> str:
-    """Запрос к LLM серверу"""
+@st.cache_resource
+def get_llm_inflight() -> Dict:
+    """Выполняющиеся сейчас запросы к LLM: ключ запроса -> Future с ответом"""
+    return {"lock": threading.Lock(), "futures": {}}
+
+def ask_llm(prompt: str, system: str, llm_url: str, model: str, api_key: str = None,
+            use_cache: bool = True, max_tokens: int = 200, errors: Optional[List[str]] = None) -> str:
+    """Запрос к LLM серверу через кэш; одинаковые одновременные запросы выполняются один раз"""
+    key = llm_cache_key(llm_url, model, system, prompt, max_tokens)
+    
+    # Повторные запросы отдаем из кэша без обращения к серверу
+    if use_cache:
+        cached_response = lookup_llm_cache(key)
+        if cached_response is not None:
+            return cached_response
+    
+    # Такой же запрос уже отправлен из другого потока - ждем его ответ
+    inflight = get_llm_inflight()
+    with inflight["lock"]:
+        future = inflight["futures"].get(key)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            inflight["futures"][key] = future
+    if not is_owner:
+        return future.result()
+    
+    response_text = ""
     try:
-        # Специальная обработка для Gemini API
-        if ('generativelanguage.googleapis.com' in llm_url or 
-            'googleapis.com' in llm_url or 
-            'gemini' in llm_url.lower()):
-            return ask_gemini(prompt, system, model, api_key)
-        
-        # Проверяем и исправляем URL
-        if not llm_url.endswith('/v1/chat/completions'):
-            llm_url = llm_url.rstrip('/') + '/v1/chat/completions'
-        
-        # Проверяем доступность сервера
-        base_url = llm_url.replace('/v1/chat/completions', '')
-        headers = {'Content-Type': 'application/json'}
-        if api_key:
-            headers['Authorization'] = f'Bearer {api_key}'
-        
-        try:
-            health_response = requests.get(f"{base_url}/health", headers=headers, timeout=5)
-        except:
-            try:
-                health_response = requests.get(f"{base_url}/v1/models", headers=headers, timeout=5)
-            except:
-                pass
+        response_text = request_llm(prompt, system, llm_url, model, api_key, max_tokens, errors)
+        if use_cache:
+            store_llm_cache(key, response_text)
+    finally:
+        with inflight["lock"]:
+            inflight["futures"].pop(key, None)
+        future.set_result(response_text)
+    return response_text
+
+def request_llm(prompt: str, system: str, llm_url: str, model: str, api_key: str = None,
+                max_tokens: int = 200, errors: Optional[List[str]] = None) -> str:
+    """Запрос к LLM серверу без кэша (текст ошибки добавляется в errors)"""
+    try:
+        endpoint = llm_endpoint(llm_url, api_key)
+        if endpoint.is_gemini:
+            return ask_gemini(prompt, system, model, api_key, max_tokens)
         
         # Формируем запрос
         data = {
@@ -497,10 +1054,10 @@ def ask_llm(prompt: str, system: str, llm_url: str, model: str, api_key: str = N
                 {"role": "user", "content": prompt}
             ],
             "temperature": 0.7,
-            "max_tokens": 200
+            "max_tokens": max_tokens
         }
         
-        response = requests.post(llm_url, json=data, headers=headers, timeout=30)
+        response = get_llm_session().post(endpoint.chat_url, json=data, headers=endpoint.headers, timeout=30)
         
         if response.status_code == 200:
             result = response.json()
@@ -509,105 +1066,444 @@ def ask_llm(prompt: str, system: str, llm_url: str, model: str, api_key: str = N
         
         return ""
         
+    except requests.exceptions.ConnectionError as e:
+        # Проверяем сервер только при ошибке, чтобы дать понятное сообщение
+        if check_llm_server(endpoint.base_url, endpoint.headers):
+            report_error(f"Ошибка соединения с LLM: {e}", errors)
+        else:
+            report_error(f"LLM сервер {endpoint.base_url} недоступен. Проверьте, что он запущен", errors)
+        return ""
     except Exception as e:
-        st.error(f"Ошибка запроса к LLM: {e}")
+        report_error(f"Ошибка запроса к LLM: {e}", errors)
         return ""
 
-def generate_smart_queries(paragraph: str, settings: Dict) -> List[str]:
-    """Генерация умных поисковых запросов через LLM"""
+def report_error(message: str, errors: Optional[List[str]]) -> None:
+    """
+    Ошибка из потока пула: пишется в лог и в список ошибок абзаца,
+    который выводит display_paragraph_result из потока скрипта
+    """
+    logger.error(message)
+    if errors is not None:
+        errors.append(message)
+
+def stream_llm(prompt: str, system: str, llm_url: str, model: str, api_key: str = None,
+               max_tokens: int = 200) -> Iterator[str]:
+    """Потоковый запрос к OpenAI-совместимому серверу: фрагменты текста по мере генерации"""
+    endpoint = llm_endpoint(llm_url, api_key)
+    
+    data = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.7,
+        "max_tokens": max_tokens,
+        "stream": True
+    }
+    
+    with get_llm_session().post(endpoint.chat_url, json=data, headers=endpoint.headers, timeout=30,
+                                stream=True) as response:
+        if response.status_code != 200:
+            return
+        
+        # Ответ приходит событиями SSE: "data: {...}" и завершающее "data: [DONE]"
+        for line in response.iter_lines():
+            if not line.startswith(b'data:'):
+                continue
+            payload = line[5:].strip()
+            if payload == b'[DONE]':
+                break
+            try:
+                chunk = json_loads(payload)
+            except ValueError:
+                continue
+            choices = chunk.get('choices') or []
+            if choices:
+                delta = (choices[0].get('delta') or {}).get('content')
+                if delta:
+                    yield delta
+
+def generate_smart_queries(paragraph: str, settings: Dict, ignore_cache: bool = False,
+                           debug_lines: Optional[List[str]] = None,
+                           errors: Optional[List[str]] = None) -> List[str]:
+    """
+    Генерация умных поисковых запросов через LLM.
+    ignore_cache - новый ответ LLM мимо кэшей (он заменяет сохраненный ответ).
+    Вызывается из потоков пула, поэтому отладочные строки и ошибки
+    не выводятся, а добавляются в debug_lines и errors
+    """
+    debug = bool(settings.get("debug_mode", False))
+    if debug_lines is None:
+        debug_lines = []
+    add_debug = debug_lines.append
     try:
         system_prompt = settings.get("system_prompt", DEFAULT_SETTINGS["system_prompt"])
         
-        user_prompt = f"Текст для анализа:\n{paragraph}\n\nСоздай короткие поисковые запросы для изображений к этому тексту."
+        # Похожие абзацы (например, после небольшой правки текста) не отправляем в LLM
+        use_semantic = settings.get("semantic_cache", True)
+        if use_semantic:
+            vector = embed_text(paragraph)
+            context = semantic_context(settings)
+            cached_queries = None if ignore_cache else lookup_semantic_cache(
+                vector, context, settings.get("semantic_threshold", 0.92)
+            )
+            if cached_queries is not None:
+                if debug:
+                    add_debug(f"🧠 Запросы из семантического кэша: {cached_queries}")
+                return cached_queries
+        
+        user_prompt = SMART_QUERY_PROMPT.format(paragraph=paragraph)
+        use_llm_cache = settings.get("llm_cache", True)
         
         response = ask_llm(
             prompt=user_prompt,
             system=system_prompt,
             llm_url=settings["llm_url"],
             model=settings["llm_model"],
-            api_key=settings.get("llm_api_key")
+            api_key=settings.get("llm_api_key"),
+            use_cache=use_llm_cache and not ignore_cache,
+            errors=errors
         )
         
         if not response:
             return []
         
+        # Повторная генерация заменяет ответ в кэше LLM
+        if ignore_cache and use_llm_cache:
+            store_llm_cache(llm_cache_key(settings["llm_url"], settings["llm_model"], system_prompt, user_prompt),
+                            response)
+        
         # Отладочная информация (можно отключить в продакшене)
-        if settings.get("debug_mode", False):
-            st.write(f"🔍 **Сырой ответ LLM:** `{response}`")
+        if debug:
+            add_debug(f"🔍 Сырой ответ LLM: {response}")
         
         # Обрабатываем ответ от LLM с тегами <think>
-        cleaned_response = clean_llm_response(response)
+        clean_queries = clean_llm_response_lines(response)
         
-        if settings.get("debug_mode", False):
-            st.write(f"🧹 **Очищенный ответ:** `{cleaned_response}`")
-            st.write(f"📏 **Длина очищенного ответа:** {len(cleaned_response)}")
-            if not cleaned_response:
-                st.error("⚠️ Очищенный ответ пустой!")
+        if debug:
+            add_debug(f"🧹 Очищенный ответ: {' | '.join(clean_queries)}")
+            if not clean_queries:
+                add_debug("⚠️ Очищенный ответ пустой!")
         
-        if not cleaned_response:
+        if not clean_queries:
             return []
         
-        # Парсим ответ
-        queries = []
-        
-        # Пробуем разные способы разделения
-        if '|' in cleaned_response:
-            queries = [q.strip() for q in cleaned_response.split('|')]
-        else:
-            queries = [q.strip() for q in cleaned_response.split('\n')]
-        
-        # Очищаем и фильтруем запросы
-        clean_queries = []
-        for query in queries:
-            query = query.strip()
-            # Убираем нумерацию и лишние символы
-            query = query.lstrip('0123456789.- ')
-            query = query.strip('"\'`')
-            
-            if query and len(query) > 2 and not query.startswith('<'):
-                clean_queries.append(query)
-        
         # Отладочная информация для запросов
-        if settings.get("debug_mode", False):
-            st.write(f"🎯 **Найдено запросов:** {len(clean_queries)}")
+        if debug:
+            add_debug(f"🎯 Найдено запросов: {len(clean_queries)}")
             
             # Безопасное получение общего количества изображений
             total_images = settings.get("image_count", 4)
             if isinstance(total_images, dict):
                 # Для множественного режима суммируем все значения
                 total_images = sum(v for k, v in total_images.items() if k.endswith('_count'))
-                st.write(f"📊 **Настройка изображений:** {settings['image_count']} (всего: {total_images})")
+                add_debug(f"📊 Настройка изображений: {settings['image_count']} (всего: {total_images})")
             else:
-                st.write(f"📊 **Настройка изображений:** {total_images} общих")
+                add_debug(f"📊 Настройка изображений: {total_images} общих")
             
             if len(clean_queries) > 0 and isinstance(total_images, int):
                 per_query = total_images // len(clean_queries)
                 remainder = total_images % len(clean_queries)
-                st.write(f"📈 **Распределение:** {per_query} на запрос + {remainder} остаток")
+                add_debug(f"📈 Распределение: {per_query} на запрос + {remainder} остаток")
             
             for i, q in enumerate(clean_queries, 1):
-                st.write(f"   {i}. `{q}`")
+                add_debug(f"   {i}. {q}")
+        
+        if use_semantic:
+            store_semantic_cache(vector, context, clean_queries)
         
         # Возвращаем ВСЕ найденные запросы без ограничений
         return clean_queries
         
     except Exception as e:
-        st.error(f"Ошибка генерации запросов: {e}")
+        report_error(f"Ошибка генерации запросов: {e}", errors)
         return []
 
-def clean_llm_response(response: str) -> str:
+def parse_queries(cleaned_response: str) -> List[str]:
+    """Разбор очищенного ответа LLM на отдельные поисковые запросы"""
+    # Пробуем разные способы разделения
+    if '|' in cleaned_response:
+        queries = cleaned_response.split('|')
+    else:
+        queries = cleaned_response.split('\n')
+    
+    # Очищаем и фильтруем запросы
+    clean_queries = []
+    for query in queries:
+        query = query.strip()
+        # Убираем нумерацию и лишние символы
+        query = query.lstrip('0123456789.- ')
+        query = query.strip('"\'`')
+        
+        if query and len(query) > 2 and not query.startswith('<'):
+            clean_queries.append(query)
+    
+    return clean_queries
+
+def split_batch_response(response: str) -> List[str]:
+    """
+    Блоки запросов из пакетного ответа LLM. Кроме строк-разделителей '###'
+    понимает JSON массив (модели часто отвечают им вместо заданного формата)
+    """
+    start = response.find('[')
+    end = response.rfind(']')
+    if start != -1 and end > start:
+        try:
+            items = json_loads(response[start:end + 1])
+        except ValueError:
+            items = None
+        if isinstance(items, list) and items:
+            # Элемент - список запросов или строка с запросами
+            return [
+                "\n".join(str(q) for q in item) if isinstance(item, list) else str(item)
+                for item in items
+            ]
+    
+    return [block for block in response.split(BATCH_DELIMITER) if block.strip()]
+
+def generate_smart_queries_batch(paragraphs: List[str], settings: Dict,
+                                 debug_lines: Optional[List[List[str]]] = None,
+                                 errors: Optional[List[List[str]]] = None) -> List[List[str]]:
+    """Генерация запросов пакетами по LLM_BATCH_SIZE абзацев на запрос к LLM.
+    
+    Пакеты отправляются параллельно; абзацы, для которых ответ
+    не удалось разобрать, обрабатываются по одному. debug_lines и errors -
+    списки отладочных строк и ошибок для каждого абзаца.
+    """
+    results: List[Optional[List[str]]] = [None] * len(paragraphs)
+    if debug_lines is None:
+        debug_lines = [[] for _ in paragraphs]
+    if errors is None:
+        errors = [[] for _ in paragraphs]
+    
+    # Абзацы из семантического кэша в пакетный запрос не включаем
+    use_semantic = settings.get("semantic_cache", True)
+    context = semantic_context(settings) if use_semantic else None
+    vectors = {}
+    pending = []
+    for i, paragraph in enumerate(paragraphs):
+        if use_semantic:
+            vectors[i] = embed_text(paragraph)
+            results[i] = lookup_semantic_cache(
+                vectors[i], context, settings.get("semantic_threshold", 0.92)
+            )
+        if results[i] is None:
+            pending.append(i)
+    
+    def run_batch(batch: List[int]) -> None:
+        try:
+            blocks_text = "\n\n".join(
+                f"Абзац {n}:\n{paragraphs[i]}" for n, i in enumerate(batch, 1)
+            )
+            user_prompt = (
+                f"Для каждого абзаца ниже создай короткие поисковые запросы для изображений. "
+                f"Верни по одному блоку запросов на абзац в том же порядке, "
+                f"блоки раздели строкой '{BATCH_DELIMITER}'.\n\n{blocks_text}"
+            )
+            
+            response = ask_llm(
+                prompt=user_prompt,
+                system=settings.get("system_prompt", DEFAULT_SETTINGS["system_prompt"]),
+                llm_url=settings["llm_url"],
+                model=settings["llm_model"],
+                api_key=settings.get("llm_api_key"),
+                use_cache=settings.get("llm_cache", True),
+                max_tokens=200 * len(batch)
+            )
+            
+            # Ответ общий для пакета, показываем его у первого абзаца
+            if settings.get("debug_mode", False):
+                debug_lines[batch[0]].append(f"🔍 Сырой пакетный ответ LLM (абзацев: {len(batch)}): {response}")
+            
+            # Рассуждения убираем до разбиения, в них тоже может встретиться разделитель
+            response = THINK_BLOCK_RE.sub('', response or '')
+            blocks = split_batch_response(response)
+            
+            if len(blocks) == len(batch):
+                for i, block in zip(batch, blocks):
+                    queries = clean_llm_response_lines(block)
+                    if queries:
+                        results[i] = queries
+                        if use_semantic:
+                            store_semantic_cache(vectors[i], context, queries)
+            else:
+                print(f"⚠️ Пакетный ответ: {len(blocks)} блоков вместо {len(batch)}, обрабатываем по одному")
+        except Exception as e:
+            print(f"❌ Ошибка пакетной генерации запросов: {e}")
+    
+    # Одиночный абзац отправлять пакетом нет смысла
+    batches = [pending[k:k + LLM_BATCH_SIZE] for k in range(0, len(pending), LLM_BATCH_SIZE)]
+    batches = [batch for batch in batches if len(batch) > 1]
+    if batches:
+        with create_executor(min(PARAGRAPH_WORKERS, len(batches))) as executor:
+            list(executor.map(run_batch, batches))
+    
+    # Запасной путь: отдельный запрос для каждого неразобранного абзаца
+    leftover = [i for i in pending if results[i] is None]
+    if leftover:
+        with create_executor(min(PARAGRAPH_WORKERS, len(leftover))) as executor:
+            single_results = executor.map(
+                lambda i: generate_smart_queries(paragraphs[i], settings, debug_lines=debug_lines[i], errors=errors[i]),
+                leftover
+            )
+            for i, queries in zip(leftover, single_results):
+                results[i] = queries
+    
+    return results
+
+def stream_smart_queries(paragraph: str, settings: Dict, on_query: Callable[[str], None],
+                         ignore_cache: bool = False, debug_lines: Optional[List[str]] = None,
+                         errors: Optional[List[str]] = None) -> List[str]:
     """
-    Очищает ответ LLM от служебных тегов и извлекает финальный ответ
+    Генерация запросов с потоковым ответом LLM. on_query вызывается для каждой
+    строки, похожей на запрос, как только она пришла, - по ней сразу начинается поиск.
+    Возвращает итоговые запросы: полный ответ очищается clean_llm_response_lines,
+    как в generate_smart_queries, поэтому часть предварительных строк в итог
+    может не попасть. Gemini, ответы из кэшей и уже выполняющийся такой же
+    запрос обрабатываются обычным generate_smart_queries
+    """
+    debug = bool(settings.get("debug_mode", False))
+    if debug_lines is None:
+        debug_lines = []
+    add_debug = debug_lines.append
+    
+    llm_url = settings["llm_url"]
+    model = settings["llm_model"]
+    system_prompt = settings.get("system_prompt", DEFAULT_SETTINGS["system_prompt"])
+    user_prompt = SMART_QUERY_PROMPT.format(paragraph=paragraph)
+    use_llm_cache = settings.get("llm_cache", True)
+    key = llm_cache_key(llm_url, model, system_prompt, user_prompt)
+    
+    def generate_without_stream() -> List[str]:
+        queries = generate_smart_queries(paragraph, settings, ignore_cache, debug_lines, errors)
+        for query in queries:
+            on_query(query)
+        return queries
+    
+    if llm_endpoint(llm_url).is_gemini:
+        return generate_without_stream()
+    if not ignore_cache and use_llm_cache and lookup_llm_cache(key, count_stats=False) is not None:
+        return generate_without_stream()
+    
+    use_semantic = settings.get("semantic_cache", True)
+    if use_semantic:
+        vector = embed_text(paragraph)
+        context = semantic_context(settings)
+        cached_queries = None if ignore_cache else lookup_semantic_cache(
+            vector, context, settings.get("semantic_threshold", 0.92)
+        )
+        if cached_queries is not None:
+            if debug:
+                add_debug(f"🧠 Запросы из семантического кэша: {cached_queries}")
+            for query in cached_queries:
+                on_query(query)
+            return cached_queries
+    
+    # Такой же запрос уже выполняется в другом потоке: ask_llm дождется его ответа
+    inflight = get_llm_inflight()
+    with inflight["lock"]:
+        if key in inflight["futures"]:
+            future = None
+        else:
+            future = Future()
+            inflight["futures"][key] = future
+    if future is None:
+        return generate_without_stream()
+    
+    emitted = set()
+    
+    def emit(line: str) -> None:
+        for part in line.split('|'):
+            query = clean_query_line(part)
+            if query and query not in emitted:
+                emitted.add(query)
+                on_query(query)
+    
+    parts = []
+    buffer = ""
+    in_think = False
+    response_text = ""
+    try:
+        stream = stream_llm(user_prompt, system_prompt, llm_url, model, settings.get("llm_api_key"))
+        for delta in stream:
+            parts.append(delta)
+            buffer += delta
+            # Готовы только строки, за которыми уже пришел перевод строки
+            *lines, buffer = buffer.split('\n')
+            for line in lines:
+                # Рассуждения внутри <think>...</think> запросами не считаем
+                if '<think>' in line:
+                    in_think = True
+                if '</think>' in line:
+                    in_think = False
+                    continue
+                if not in_think:
+                    emit(line)
+        
+        if not in_think:
+            emit(buffer)
+        response_text = "".join(parts)
+    except Exception as e:
+        print(f"⚠️ Потоковый ответ LLM прерван: {e}")
+    finally:
+        with inflight["lock"]:
+            inflight["futures"].pop(key, None)
+        future.set_result(response_text)
+    
+    if not response_text:
+        # Поток прерван или сервер отказал: обычный запрос повторит попытку и сообщит причину
+        return generate_without_stream()
+    
+    if debug:
+        add_debug(f"🔍 Сырой потоковый ответ LLM: {response_text}")
+    if use_llm_cache:
+        store_llm_cache(key, response_text)
+    
+    queries = clean_llm_response_lines(response_text)
+    if debug:
+        add_debug(f"🧹 Очищенный ответ: {' | '.join(queries)}")
+    if queries and use_semantic:
+        store_semantic_cache(vector, context, queries)
+    
+    # Запросы, которые построчный разбор не распознал (например, список через '|' с объяснением)
+    for query in queries:
+        if query not in emitted:
+            on_query(query)
+    return queries
+
+def clean_query_line(line: str) -> Optional[str]:
+    """Одна строка ответа LLM как поисковый запрос или None, если это не запрос"""
+    line = line.strip()
+    
+    # Пропускаем пустые строки и длинные объяснения (больше 50 символов)
+    if not line or len(line) > 50:
+        return None
+    
+    # Пропускаем строки с объяснениями
+    if EXPLANATION_LINE_RE.match(line):
+        return None
+    
+    # Убираем нумерацию и маркеры, кавычки и лишние символы
+    line = LIST_MARKER_RE.sub('', line).strip()
+    line = line.strip('"\'`')
+    
+    # Проверяем, что строка не пустая, достаточно длинная, но не слишком длинная
+    if line and 5 <= len(line) <= 50 and not line.startswith('<'):
+        return line
+    return None
+
+def clean_llm_response_lines(response: str) -> List[str]:
+    """
+    Очищает ответ LLM от служебных тегов и возвращает готовый список запросов
     """
     try:
-        import re
-        
         # Обрабатываем случай с незакрытым тегом think
         if 'think' in response.lower():
             # Ищем паттерны think (с тегами или без)
             if '<think>' in response and '</think>' in response:
                 # Стандартный случай с закрытыми тегами
-                response = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL)
+                response = THINK_BLOCK_RE.sub('', response)
             elif 'think' in response.lower():
                 # Случай с незакрытым think или /think
                 # Ищем все после последнего упоминания think или /think
@@ -623,11 +1519,11 @@ def clean_llm_response(response: str) -> str:
                     # Берем текст после последнего think/think
                     after_think = response[last_think_pos:]
                     # Убираем сам паттерн think
-                    after_think = re.sub(r'^[/]?think\s*', '', after_think, flags=re.IGNORECASE)
+                    after_think = THINK_PREFIX_RE.sub('', after_think)
                     response = after_think.strip()
         
         # Удаляем любые оставшиеся XML-подобные теги
-        response = re.sub(r'<[^>]+>', '', response)
+        response = XML_TAG_RE.sub('', response)
         
         # Удаляем лишние пробелы в начале и конце
         response = response.strip()
@@ -635,89 +1531,112 @@ def clean_llm_response(response: str) -> str:
         # Если ответ слишком длинный (больше 500 символов), скорее всего это объяснение
         if len(response) > 500:
             # Ищем короткие строки в конце - они скорее всего запросы
-            lines = response.split('\n')
-            short_lines = []
+            # Максимум 6 запросов: deque сам вытесняет более ранние строки
+            short_lines = deque(maxlen=6)
             
-            # Берем строки из конца, которые короче 50 символов
-            for line in reversed(lines):
+            # Берем последние строки, которые короче 50 символов
+            for line in response.split('\n'):
                 line = line.strip()
                 if line and len(line) < 50 and len(line) > 5:
-                    short_lines.insert(0, line)
-                    if len(short_lines) >= 6:  # Максимум 6 запросов
-                        break
+                    short_lines.append(line)
             
             if short_lines:
                 response = '\n'.join(short_lines)
         
         # Разбиваем на строки и очищаем каждую
-        lines = response.split('\n')
         clean_lines = []
-        
-        for line in lines:
-            line = line.strip()
-            
-            # Пропускаем пустые строки
-            if not line:
-                continue
-                
-            # Пропускаем длинные объяснения (больше 50 символов)
-            if len(line) > 50:
-                continue
-                
-            # Пропускаем строки с объяснениями
-            if line.startswith(('Вот', 'Для', 'Я создал', 'Создал', 'Анализ', 'Текст', 'Поисковые запросы', 'Запросы', 'Хм,', 'Пользователь')):
-                continue
-                
-            # Убираем нумерацию и маркеры
-            line = re.sub(r'^[\d\.\-\•\*\s]+', '', line).strip()
-            
-            # Убираем кавычки и лишние символы
-            line = line.strip('"\'`')
-            
-            # Проверяем, что строка не пустая, достаточно длинная, но не слишком длинная
-            if line and 5 <= len(line) <= 50 and not line.startswith('<'):
+        for line in response.split('\n'):
+            line = clean_query_line(line)
+            if line:
                 clean_lines.append(line)
         
-        # Возвращаем очищенные строки
+        # Запросы через '|' в одной строке разбиваем отдельно
+        if len(clean_lines) == 1 and '|' in clean_lines[0]:
+            return parse_queries(clean_lines[0])
         if clean_lines:
-            return '\n'.join(clean_lines)
+            return clean_lines
         
-        # Если ничего не найдено, возвращаем исходный ответ без тегов
-        return response
+        # Если ничего не найдено, разбираем исходный ответ без тегов
+        return parse_queries(response)
         
     except Exception as e:
         print(f"Ошибка очистки ответа LLM: {e}")
-        return response
+        return []
+
+# === ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ===
+def create_executor(max_workers: int) -> ThreadPoolExecutor:
+    """
+    Пул потоков для сетевых задач. Потокам передается контекст скрипта,
+    без которого st.cache_data в них работает с предупреждениями. Виджеты
+    из потоков не выводятся: результаты рисует поток скрипта
+    """
+    if add_script_run_ctx is None:
+        return ThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx())
+    )
+
+@st.cache_resource
+def get_search_session() -> requests.Session:
+    """
+    Общая сессия для поисковиков изображений. Пул рассчитан на все потоки
+    поиска всех абзацев, политика повторов - как в image_utils
+    """
+    return image_utils.create_robust_session(pool_size=PARAGRAPH_WORKERS * SEARCH_WORKERS)
+
+@st.cache_data(ttl=IMAGE_CHECK_TTL, max_entries=4096, show_spinner=False)
+def url_ok(url: str) -> bool:
+    """Доступность изображения по ссылке (HEAD, при отказе сервера - GET без тела)"""
+    if not url or not url.startswith(('http://', 'https://')):
+        return False
+    
+    session = get_search_session()
+    try:
+        response = session.head(url, timeout=IMAGE_CHECK_TIMEOUT, allow_redirects=True)
+        # Некоторые CDN не поддерживают HEAD или запрещают его
+        if response.status_code in (403, 405, 501):
+            response = session.get(url, timeout=IMAGE_CHECK_TIMEOUT, allow_redirects=True, stream=True)
+            response.close()
+        return response.status_code < 400
+    except requests.exceptions.RequestException:
+        return False
 
 # === ФУНКЦИИ ОБРАБОТКИ ТЕКСТА ===
+def split_long_paragraph(paragraph: str, limit: int = LONG_PARAGRAPH_LIMIT) -> List[str]:
+    """Разделение длинного абзаца на части до limit символов по границам предложений"""
+    # Границы предложений как (начало, конец) без копирования строк
+    spans = []
+    start = 0
+    for match in SENTENCE_BOUNDARY_RE.finditer(paragraph):
+        spans.append((start, match.start()))
+        start = match.end()
+    spans.append((start, len(paragraph)))
+    
+    chunks = []
+    chunk_start, chunk_end = spans[0]
+    for sentence_start, sentence_end in spans[1:]:
+        if sentence_end - chunk_start < limit:
+            chunk_end = sentence_end
+        else:
+            chunks.append(paragraph[chunk_start:chunk_end])
+            chunk_start, chunk_end = sentence_start, sentence_end
+    chunks.append(paragraph[chunk_start:chunk_end])
+    
+    return chunks
+
 def split_text_into_paragraphs(text: str, split_long: bool = False) -> List[str]:
     """Разделение текста на абзацы"""
-    # Разделяем по двойным переносам строк
-    paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
-    
-    if not paragraphs:
-        # Если нет двойных переносов, разделяем по одинарным
-        paragraphs = [p.strip() for p in text.split('\n') if p.strip()]
+    # Разделяем по пустым строкам
+    paragraphs = [p for p in map(str.strip, PARAGRAPH_SPLIT_RE.split(text)) if p]
     
-    if split_long:
-        # Разделяем длинные абзацы (более 500 символов)
+    # Разделяем длинные абзацы (более LONG_PARAGRAPH_LIMIT символов)
+    if split_long and any(len(p) > LONG_PARAGRAPH_LIMIT for p in paragraphs):
         split_paragraphs = []
         for p in paragraphs:
-            if len(p) > 500:
-                # Разделяем по предложениям
-                sentences = p.split('. ')
-                current_chunk = ""
-                
-                for sentence in sentences:
-                    if len(current_chunk + sentence) < 500:
-                        current_chunk += sentence + ". "
-                    else:
-                        if current_chunk:
-                            split_paragraphs.append(current_chunk.strip())
-                        current_chunk = sentence + ". "
-                
-                if current_chunk:
-                    split_paragraphs.append(current_chunk.strip())
+            if len(p) > LONG_PARAGRAPH_LIMIT:
+                split_paragraphs.extend(split_long_paragraph(p))
             else:
                 split_paragraphs.append(p)
         
@@ -725,8 +1644,61 @@ def split_text_into_paragraphs(text: str, split_long: bool = False) -> List[str]
     
     return paragraphs
 
-def process_paragraph(paragraph: str, settings: Dict) -> Dict:
-    """Обработка одного абзаца"""
+@dataclass(frozen=True)
+class ImageBudget:
+    """План распределения изображений по запросам (один на весь запуск)"""
+    total: Optional[int]  # None, если количество задается для каждого поисковика
+    engine: str = "duckduckgo"  # Поисковик одиночного режима
+    engine_counts: Dict[str, int] = field(default_factory=dict)  # Множественный режим
+    
+    def split(self, query_count: int) -> tuple:
+        """Изображений на запрос и остаток, который добавляется к первым запросам"""
+        if self.total is None or query_count == 0:
+            return 1, 0
+        per_query, remainder = divmod(self.total, query_count)
+        return max(1, per_query), remainder
+
+def plan_image_budget(settings: Dict) -> ImageBudget:
+    """Приведение настроек количества изображений к плану поиска"""
+    # Безопасное получение общего количества изображений
+    total_images = settings.get("image_count", 4)
+    if isinstance(total_images, dict):
+        # Для множественного режима используем индивидуальные настройки
+        total_images = None
+    
+    search_engine = settings["search_engine"]
+    if isinstance(search_engine, list):
+        return ImageBudget(
+            total=total_images,
+            engine_counts={engine: settings.get(f"{engine}_count", 3) for engine in search_engine}
+        )
+    return ImageBudget(total=total_images, engine=search_engine)
+
+def can_stream_queries(settings: Dict, budget: ImageBudget) -> bool:
+    """
+    Потоковая генерация запросов. Она нужна только в множественном режиме: там число
+    изображений на поисковик не зависит от количества запросов, и поиск по первому
+    запросу можно начинать, пока LLM генерирует остальные
+    """
+    return bool(settings["smart_queries"] and settings.get("stream_queries", True) and budget.engine_counts)
+
+def process_paragraph(paragraph: str, settings: Dict, budget: Optional[ImageBudget] = None,
+                      queries: Optional[List[str]] = None, ignore_cache: bool = False,
+                      debug_lines: Optional[List[str]] = None,
+                      errors: Optional[List[str]] = None) -> Dict:
+    """
+    Обработка одного абзаца (ignore_cache - новые запросы LLM и поиск мимо кэшей).
+    debug_lines и errors - строки, уже накопленные для абзаца пакетной генерацией
+    """
+    if budget is None:
+        budget = plan_image_budget(settings)
+    debug = bool(settings.get("debug_mode", False))
+    # Абзац обрабатывается в потоке пула: отладочные строки возвращаются в результате
+    # и выводятся одним блоком в display_paragraph_result, а не виджетом на каждый запрос
+    debug_lines = [] if debug_lines is None else debug_lines
+    errors = [] if errors is None else errors
+    add_debug = debug_lines.append
+    
     result = {
         "text": paragraph,
         "queries": [],
@@ -735,134 +1707,281 @@ def process_paragraph(paragraph: str, settings: Dict) -> Dict:
     }
     
     try:
-        # Генерируем поисковые запросы
-        if settings["smart_queries"]:
-            # Убираем ограничение query_count - используем все запросы от LLM
-            queries = generate_smart_queries(paragraph, settings)
-        else:
-            # Простая генерация запросов (первые слова абзаца)
-            words = paragraph.split()[:3]
-            queries = [" ".join(words)] if words else []
-        
-        result["queries"] = queries
+        searxng_url = settings.get("searxng_url", "http://localhost:8080")
+        http_session = get_search_session()
+        
+        def run_search(task):
+            query, engine, count = task
+            images = search_images(
+                query=query,
+                max_results=count,
+                search_engine=engine,
+                searxng_url=searxng_url,
+                session=http_session,
+                ignore_cache=ignore_cache
+            )
+            
+            # Добавляем метаданные
+            for img in images:
+                img["query"] = query
+                img["search_engine"] = engine
+            return images
         
         # Поиск изображений по запросам
         all_images = []
         
-        # Определяем количество изображений на запрос
-        if len(queries) > 0:
-            # Безопасное получение общего количества изображений
-            total_images = settings.get("image_count", 4)
-            if isinstance(total_images, dict):
-                # Для множественного режима используем индивидуальные настройки
-                images_per_query = 1  # Минимум 1 изображение на запрос
-                remainder = 0
-            else:
-                # Распределяем общее количество изображений между запросами
-                images_per_query = max(1, total_images // len(queries))
-                # Если остается остаток, добавляем к первым запросам
-                remainder = total_images % len(queries)
-        else:
-            images_per_query = 1
-            remainder = 0
-        
-        for i, query in enumerate(queries):
-            if query:
-                # Определяем количество изображений для этого запроса
-                current_count = images_per_query
-                if i < remainder:  # Добавляем остаток к первым запросам
-                    current_count += 1
+        if queries is None and can_stream_queries(settings, budget):
+            # Поиск по каждому запросу начинается, как только LLM его выдала
+            with create_executor(SEARCH_WORKERS) as executor:
+                searches = {}
                 
-                if settings.get("debug_mode", False):
-                    st.write(f"🔍 **Запрос {i+1}:** `{query}` (ищем {current_count} изображений)")
+                def start_search(query: str) -> None:
+                    if query in searches:
+                        return
+                    if debug:
+                        add_debug(f"🔍 Запрос {len(searches) + 1}: {query}")
+                    searches[query] = [
+                        executor.submit(run_search, (query, engine, engine_count))
+                        for engine, engine_count in budget.engine_counts.items()
+                    ]
                 
-                # Определяем тип поиска
-                if isinstance(settings["search_engine"], list):
-                    # Множественный режим - используем индивидуальные настройки
-                    engine_images = {}
-                    for engine in settings["search_engine"]:
-                        engine_count = settings.get(f"{engine}_count", 3)
-                        # В множественном режиме используем настройки для каждого поисковика
-                        engine_images[engine] = engine_count
-                    
-                    # Поиск с индивидуальными настройками
-                    for engine in settings["search_engine"]:
-                        engine_count = engine_images.get(engine, 1)
-                        
-                        if settings.get("debug_mode", False):
-                            st.write(f"   🔍 {engine}: ищем {engine_count} изображений")
-                        
-                        images = search_images(
-                            query=query,
-                            max_results=engine_count,
-                            search_engine=engine,
-                            searxng_url=settings.get("searxng_url", "http://localhost:8080")
-                        )
-                        
-                        # Добавляем метаданные
-                        for img in images:
-                            img["query"] = query
-                            img["search_engine"] = engine
-                        
-                        all_images.extend(images)
-                else:
-                    # Одиночный режим
-                    images = search_images(
-                        query=query,
-                        max_results=current_count,
-                        search_engine=settings["search_engine"],
-                        searxng_url=settings.get("searxng_url", "http://localhost:8080")
-                    )
+                queries = stream_smart_queries(paragraph, settings, start_search, ignore_cache,
+                                               debug_lines, errors)
+                for query in queries:
+                    for future in searches[query]:
+                        all_images.extend(future.result())
+                
+                # Строки, отброшенные полной очисткой ответа, в результат не попадают
+                for query, futures in searches.items():
+                    if query not in queries:
+                        for future in futures:
+                            future.cancel()
+            
+            result["queries"] = queries
+        else:
+            # Генерируем поисковые запросы
+            if queries is not None:
+                # Запросы уже получены пакетной генерацией
+                pass
+            elif settings["smart_queries"]:
+                # Убираем ограничение query_count - используем все запросы от LLM
+                queries = generate_smart_queries(paragraph, settings, ignore_cache, debug_lines, errors)
+            else:
+                # Простая генерация запросов (первые слова абзаца)
+                match = FIRST_WORDS_RE.match(paragraph)
+                queries = [" ".join(word for word in match.groups() if word)] if match else []
+            
+            result["queries"] = queries
+            
+            # Определяем количество изображений на запрос
+            images_per_query, remainder = budget.split(len(queries))
+            
+            # Собираем задачи поиска: (запрос, поисковик, количество)
+            search_tasks = []
+            add_task = search_tasks.append
+            engine_counts = budget.engine_counts
+            single_engine = budget.engine
+            for i, query in enumerate(queries):
+                if query:
+                    # Определяем количество изображений для этого запроса
+                    current_count = images_per_query
+                    if i < remainder:  # Добавляем остаток к первым запросам
+                        current_count += 1
                     
-                    # Добавляем метаданные
-                    for img in images:
-                        img["query"] = query
-                        img["search_engine"] = settings["search_engine"]
+                    if debug:
+                        add_debug(f"🔍 Запрос {i+1}: {query} (ищем {current_count} изображений)")
                     
-                    all_images.extend(images)
+                    # Определяем тип поиска
+                    if engine_counts:
+                        # Множественный режим - используем индивидуальные настройки
+                        for engine, engine_count in engine_counts.items():
+                            if debug:
+                                add_debug(f"   🔍 {engine}: ищем {engine_count} изображений")
+                            
+                            add_task((query, engine, engine_count))
+                    else:
+                        # Одиночный режим
+                        add_task((query, single_engine, current_count))
+            
+            # Запросы к поисковикам выполняются параллельно, порядок результатов сохраняется
+            if search_tasks:
+                with create_executor(min(SEARCH_WORKERS, len(search_tasks))) as executor:
+                    for images in executor.map(run_search, search_tasks):
+                        all_images.extend(images)
+        
+        # Разные запросы и поисковики часто находят одни и те же картинки
+        all_images = dedupe_images(all_images)
+        
+        # Недоступные изображения отбрасываем до вывода и отчета (по запросу пользователя:
+        # это HEAD запрос на каждое изображение абзаца, кэшируемый на IMAGE_CHECK_TTL)
+        if settings.get("validate_images", False) and all_images:
+            with create_executor(min(SEARCH_WORKERS, len(all_images))) as executor:
+                checks = list(executor.map(url_ok, [img.get("url", "") for img in all_images]))
+            all_images = [img for img, ok in zip(all_images, checks) if ok]
         
         result["images"] = all_images
         
         # Поиск изображений по URL (если включено)
-        if settings["url_parsing"]:
+        if settings["url_parsing"] and URL_RE.search(paragraph):
             url_images = search_images_from_urls(paragraph, max_images_per_url=2)
             result["url_images"] = url_images
         
     except Exception as e:
-        st.error(f"Ошибка обработки абзаца: {e}")
+        # Абзац обрабатывается в потоке пула: ошибку показывает display_paragraph_result
+        logger.exception("Ошибка обработки абзаца")
+        errors.append(f"Ошибка обработки абзаца: {e}")
+    
+    if errors:
+        result["errors"] = errors
+    if debug_lines:
+        result["debug_lines"] = debug_lines
     
     return result
 
-# === ФУНКЦИИ СОЗДАНИЯ ОТЧЕТОВ ===
-def create_html_report(results: List[Dict], settings: Dict) -> str:
-    """Создание HTML отчета"""
+def dedupe_images(images: List[Dict]) -> List[Dict]:
+    """
+    Удаление повторов по URL без схемы и якоря. Параметры запроса учитываются:
+    у прокси-превью (Google, DuckDuckGo) путь одинаковый, а картинки разные
+    """
+    seen = set()
+    unique = []
+    for img in images:
+        url = img.get("url", "")
+        try:
+            parts = urlsplit(url)
+            key = (parts.netloc.lower(), parts.path, parts.query)
+        except ValueError:
+            key = url
+        if key not in seen:
+            seen.add(key)
+            unique.append(img)
+    return unique
+
+def process_cache_key(settings: Dict) -> str:
+    """Ключ кэша обработки: только настройки, влияющие на запросы и поиск"""
+    relevant = {k: v for k, v in settings.items() if k not in PROCESS_CACHE_IGNORED}
+    return text_digest(json.dumps(relevant, sort_keys=True, ensure_ascii=False))
+
+def paragraph_cache_key(paragraph_digest: str, settings_key: str) -> str:
+    """
+    Ключ готового результата абзаца при данных настройках. Текст абзаца
+    хэшируется один раз (text_digest), отпечаток хранится в результате
+    """
+    return f"{settings_key}:{paragraph_digest}"
+
+def text_digest(text: str) -> str:
+    """Короткий отпечаток текста для ключей кэша (32 hex-символа)"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+def lookup_paragraph_cache(key: str) -> Optional[Dict]:
+    """Сохраненный результат абзаца или None, если его нет или он старше PROCESS_CACHE_TTL"""
     try:
-        # Создаем базовый шаблон если его нет
-        template_path = os.path.join(TEMPLATE_DIR, "report.html")
-        if not os.path.exists(template_path):
-            create_default_template()
-        
-        # Загружаем шаблон
-        env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
-        template = env.get_template("report.html")
-        
-        # Подготавливаем данные
+        cache = get_llm_cache()
+        with cache["lock"]:
+            row = cache["conn"].execute(
+                "SELECT result FROM paragraphs WHERE key = ? AND ts > ?",
+                (key, int(time.time()) - PROCESS_CACHE_TTL)
+            ).fetchone()
+        return json_loads(row[0]) if row else None
+    except (sqlite3.Error, ValueError) as e:
+        print(f"Ошибка чтения кэша абзацев: {e}")
+        return None
+
+def is_complete_result(result: Dict) -> bool:
+    """
+    Результат без ошибок, с запросами и изображениями. Пустой результат обычно
+    значит, что LLM или поисковик были недоступны, - его не запоминаем
+    """
+    return (not result.get("errors") and bool(result["queries"])
+            and bool(result["images"] or result["url_images"]))
+
+def store_paragraph_cache(key: str, result: Dict) -> None:
+    """
+    Сохранение результата абзаца на диск (только полного, см. is_complete_result).
+    Устаревшие и лишние сверх PROCESS_CACHE_LIMIT результаты удаляются сразу
+    """
+    if not is_complete_result(result):
+        return
+    
+    # Отладочный вывод относится к конкретному запуску, его не сохраняем
+    cacheable = {k: v for k, v in result.items() if k != "debug_lines"}
+    now = int(time.time())
+    try:
+        cache = get_llm_cache()
+        with cache["lock"], cache["conn"]:
+            cache["conn"].execute(
+                "INSERT OR REPLACE INTO paragraphs (key, result, ts) VALUES (?, ?, ?)",
+                (key, json_dumps(cacheable).decode('utf-8'), now)
+            )
+            cache["conn"].execute(
+                "DELETE FROM paragraphs WHERE ts <= ? OR key NOT IN "
+                "(SELECT key FROM paragraphs ORDER BY ts DESC LIMIT ?)",
+                (now - PROCESS_CACHE_TTL, PROCESS_CACHE_LIMIT)
+            )
+    except sqlite3.Error as e:
+        print(f"Ошибка записи кэша абзацев: {e}")
+
+def process_paragraph_cached(paragraph: str, settings: Dict, cache_key: str,
+                             budget: Optional[ImageBudget] = None,
+                             queries: Optional[List[str]] = None,
+                             debug_lines: Optional[List[str]] = None,
+                             errors: Optional[List[str]] = None) -> Dict:
+    """Обработка абзаца с сохранением полного результата в кэш абзацев"""
+    result = process_paragraph(paragraph, settings, budget, queries,
+                               debug_lines=debug_lines, errors=errors)
+    store_paragraph_cache(cache_key, result)
+    return result
+
+# === ФУНКЦИИ СОЗДАНИЯ ОТЧЕТОВ ===
+@st.cache_resource
+def get_jinja_env() -> Environment:
+    """
+    Окружение Jinja2 создается один раз за процесс. Скомпилированный шаблон
+    хранится в памяти и в байткод-кэше на диске, поэтому не разбирается заново
+    """
+    return Environment(
+        loader=FileSystemLoader(TEMPLATE_DIR),
+        bytecode_cache=FileSystemBytecodeCache(JINJA_CACHE_DIR),
+        # Текст абзацев и запросы приходят от пользователя и LLM, экранируем их
+        autoescape=True,
+        auto_reload=False
+    )
+
+def render_html_report(results: List[Dict], settings: Dict, total_images: Optional[int] = None) -> str:
+    """
+    Рендер HTML отчета. Результат не кэшируется: в отчете время генерации,
+    а шаблон и так скомпилирован один раз (см. get_jinja_env)
+    """
+    # Создаем базовый шаблон если его нет
+    template_path = os.path.join(TEMPLATE_DIR, "report.html")
+    if not os.path.exists(template_path):
+        create_default_template()
+    
+    # Загружаем шаблон
+    template = get_jinja_env().get_template("report.html")
+    
+    # Подготавливаем данные (main уже посчитал изображения для истории)
+    if total_images is None:
         total_images = sum(len(r["images"]) + len(r["url_images"]) for r in results)
-        
-        # Рендерим HTML
-        html_content = template.render(
-            results=results,
-            settings=settings,
-            total_paragraphs=len(results),
-            total_images=total_images,
-            generation_time=time.strftime("%Y-%m-%d %H:%M:%S")
-        )
+    
+    # Рендерим HTML
+    return template.render(
+        results=results,
+        settings=settings,
+        total_paragraphs=len(results),
+        total_images=total_images,
+        generation_time=time.strftime("%Y-%m-%d %H:%M:%S")
+    )
+
+def create_html_report(results: List[Dict], settings: Dict, total_images: Optional[int] = None) -> str:
+    """Создание HTML отчета: возвращает HTML и сохраняет копию в HTML_OUT"""
+    try:
+        html_content = render_html_report(results, settings, total_images)
         
         # Сохраняем файл
-        with open(HTML_OUT, 'w', encoding='utf-8') as f:
-            f.write(html_content)
+        Path(HTML_OUT).write_bytes(html_content.encode('utf-8'))
         
-        return HTML_OUT
+        return html_content
         
     except Exception as e:
         st.error(f"Ошибка создания HTML отчета: {e}")
@@ -937,6 +2056,18 @@ def create_default_template():
     with open(template_path, 'w', encoding='utf-8') as f:
         f.write(template_content)
 
+# === НАСТРОЙКА СБОРЩИКА МУСОРА ===
+@st.cache_resource
+def configure_gc() -> bool:
+    """
+    Один раз на процесс: реже запускаем сборку поколений и замораживаем
+    уже загруженные объекты (модули, настройки), чтобы сборщик их не обходил
+    """
+    gc.set_threshold(*GC_THRESHOLD)
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    return True
+
 # === ОСНОВНОЕ ПРИЛОЖЕНИЕ ===
 def main():
     """Основная функция приложения"""
@@ -953,6 +2084,10 @@ def main():
     if 'settings' not in st.session_state:
         st.session_state.settings = load_settings()
     
+    configure_gc()
+    if st.session_state.settings.get("semantic_cache", True):
+        warm_up_sentence_encoder()
+    
     # Боковая панель с настройками
     with st.sidebar:
         st.header("⚙️ Настройки")
@@ -1044,8 +2179,8 @@ def main():
                 )
                 
                 if st.button("💾 Сохранить промпт"):
-                    prompts[selected_prompt] = edited_prompt
-                    save_custom_prompts(prompts)
+                    with edit_prompts() as edited_prompts:
+                        edited_prompts[selected_prompt] = edited_prompt
                     st.success("Промпт сохранен!")
                     st.rerun()
             else:
@@ -1070,8 +2205,8 @@ def main():
                 with col_create:
                     if st.button("✅ Создать", key="create_prompt"):
                         if new_name and new_name.strip():
-                            prompts[new_name.strip()] = "Создай короткие поисковые запросы для изображений к тексту."
-                            save_custom_prompts(prompts)
+                            with edit_prompts() as edited_prompts:
+                                edited_prompts[new_name.strip()] = "Создай короткие поисковые запросы для изображений к тексту."
                             st.success(f"Промпт '{new_name}' создан!")
                             st.session_state.show_new_prompt = False
                             st.rerun()
@@ -1095,8 +2230,8 @@ def main():
                     
                     with col_delete:
                         if st.button("✅ Да, удалить", key="confirm_delete"):
-                            del prompts[selected_prompt]
-                            save_custom_prompts(prompts)
+                            with edit_prompts() as edited_prompts:
+                                edited_prompts.pop(selected_prompt, None)
                             st.success(f"Промпт '{selected_prompt}' удален!")
                             st.session_state.show_delete_confirm = False
                             st.rerun()
@@ -1224,21 +2359,33 @@ def main():
         # Настройки количества изображений
         if search_mode == "Множественный выбор" and isinstance(search_engine, list):
             st.markdown("**🎯 Изображений для каждого поисковика:**")
-            engine_counts = {}
-            total_images = 0
-            
-            for engine in search_engine:
-                count = st.slider(
-                    f"{engine.title()}",
-                    min_value=1,
-                    max_value=10,
-                    value=st.session_state.settings.get(f"{engine}_count", 3),
-                    key=f"count_{engine}"
+            counts = [st.session_state.settings.get(f"{engine}_count", 3) for engine in search_engine]
+            
+            if hasattr(st, "data_editor"):
+                # Одна таблица вместо слайдера на каждый поисковик: один виджет и одно событие на правку
+                edited = st.data_editor(
+                    {"Поисковик": list(search_engine), "Изображений": counts},
+                    num_rows="fixed",
+                    hide_index=True,
+                    disabled=["Поисковик"],
+                    column_config={
+                        "Изображений": st.column_config.NumberColumn(min_value=1, max_value=10, step=1,
+                                                                      required=True)
+                    },
+                    # Правки таблицы привязаны к строкам, поэтому при смене набора поисковиков ключ новый
+                    key=f"engine_counts_{'_'.join(search_engine)}"
                 )
-                engine_counts[f"{engine}_count"] = count
-                total_images += count
+                # Очищенная ячейка приходит как NaN (столбец становится float): NaN != NaN
+                counts = [min(10, max(1, int(count))) if count is not None and count == count else 1
+                          for count in edited["Изображений"]]
+            else:
+                counts = [
+                    st.slider(f"{engine.title()}", min_value=1, max_value=10, value=count, key=f"count_{engine}")
+                    for engine, count in zip(search_engine, counts)
+                ]
             
-            st.info(f"Всего изображений: {total_images}")
+            engine_counts = {f"{engine}_count": count for engine, count in zip(search_engine, counts)}
+            st.info(f"Всего изображений: {sum(counts)}")
             image_count = engine_counts
         else:
             # Получаем значение по умолчанию для слайдера
@@ -1267,17 +2414,53 @@ def main():
             value=st.session_state.settings["url_parsing"]
         )
         
+        validate_images = st.checkbox(
+            "Проверять ссылки на изображения",
+            value=st.session_state.settings.get("validate_images", False),
+            help="Недоступные изображения отбрасываются до вывода. Добавляет запрос на каждое найденное "
+                 "изображение (результат проверки кэшируется на час)"
+        )
+        
         split_long = st.checkbox(
             "Разделять длинные абзацы",
             value=st.session_state.settings["split_long_paragraphs"]
         )
         
+        batch_queries = st.checkbox(
+            "📦 Пакетная генерация запросов",
+            value=st.session_state.settings.get("batch_queries", True),
+            help="Запросы для всех абзацев генерируются одним обращением к LLM"
+        )
+        
+        stream_queries = st.checkbox(
+            "⚡ Потоковая генерация запросов",
+            value=st.session_state.settings.get("stream_queries", True),
+            help="При выборе нескольких поисковиков поиск по запросу начинается, пока LLM генерирует остальные "
+                 "(вместо пакетной генерации). Для Gemini и одного поисковика не используется"
+        )
+        
+        llm_cache = st.checkbox(
+            "💾 Кэшировать ответы LLM",
+            value=st.session_state.settings.get("llm_cache", True),
+            help="Повторные запросы с тем же текстом, промптом и моделью не отправляются на сервер"
+        )
+        
+        semantic_cache = st.checkbox(
+            "🧠 Семантический кэш запросов",
+            value=st.session_state.settings.get("semantic_cache", True),
+            help="Для почти одинаковых абзацев повторно используются ранее сгенерированные запросы"
+        )
+        
         debug_mode = st.checkbox(
             "🐛 Режим отладки LLM",
             value=st.session_state.settings.get("debug_mode", False),
             help="Показывать сырые ответы от LLM для отладки"
         )
         
+        if debug_mode:
+            cache_stats = get_llm_cache()["stats"]
+            st.caption(f"Кэш LLM: {cache_stats['hits']} попаданий, {cache_stats['misses']} промахов")
+        
         # Сохраняем настройки при изменении
         new_settings = {
             "llm_url": llm_url,
@@ -1286,8 +2469,14 @@ def main():
             "search_engine": search_engine,
             "image_count": image_count,
             "smart_queries": smart_queries,
+            "batch_queries": batch_queries,
             "url_parsing": url_parsing,
+            "validate_images": validate_images,
             "split_long_paragraphs": split_long,
+            "llm_cache": llm_cache,
+            "semantic_cache": semantic_cache,
+            "semantic_threshold": st.session_state.settings.get("semantic_threshold", 0.92),
+            "stream_queries": stream_queries,
             "debug_mode": debug_mode,
             "system_prompt": edited_prompt,
             "search_language": st.session_state.settings["search_language"],
@@ -1300,7 +2489,7 @@ def main():
         
         if new_settings != st.session_state.settings:
             st.session_state.settings = new_settings
-            save_settings(new_settings)
+            schedule_settings_save(new_settings)
     
     # Основной интерфейс
     col1, col2 = st.columns([2, 1])
@@ -1328,30 +2517,81 @@ def main():
                 st.error("Не удалось разделить текст на абзацы")
                 return
             
-            # Инициализируем результаты в session_state
-            if 'processing_results' not in st.session_state:
-                st.session_state.processing_results = []
-            
-            # Очищаем предыдущие результаты
-            st.session_state.processing_results = []
+            # Результаты по индексам абзацев: список создается один раз нужного размера
+            # и заполняется по мере готовности, без пересоздания и дописывания
+            paragraph_results = [None] * len(paragraphs)
+            st.session_state.processing_results = paragraph_results
             
             # Обрабатываем каждый абзац динамически
             progress_bar = st.progress(0)
             status_text = st.empty()
             results_container = st.container()
             
-            for i, paragraph in enumerate(paragraphs):
-                status_text.text(f"Обрабатываем абзац {i+1} из {len(paragraphs)}...")
-                progress_bar.progress((i + 1) / len(paragraphs))
-                
-                # Обрабатываем абзац
-                result = process_paragraph(paragraph, st.session_state.settings)
-                result['paragraph_index'] = i
-                st.session_state.processing_results.append(result)
+            settings = st.session_state.settings
+            budget = plan_image_budget(settings)
+            settings_key = process_cache_key(settings)
+            
+            # Готовые результаты берем из кэша до обращения к LLM
+            digests = [text_digest(paragraph) for paragraph in paragraphs]
+            cache_keys = [paragraph_cache_key(digest, settings_key) for digest in digests]
+            missing = []
+            for i, key in enumerate(cache_keys):
+                cached_result = lookup_paragraph_cache(key)
+                if cached_result is None:
+                    missing.append(i)
+                else:
+                    cached_result['paragraph_index'] = i
+                    cached_result['digest'] = digests[i]
+                    paragraph_results[i] = cached_result
+            
+            # Запросы для остальных абзацев получаем пакетными обращениями к LLM
+            paragraph_queries = [None] * len(paragraphs)
+            # Отладочные строки и ошибки потоков выводятся вместе с результатом абзаца
+            paragraph_debug = [[] for _ in paragraphs]
+            paragraph_errors = [[] for _ in paragraphs]
+            # При потоковой генерации запросы каждого абзаца получает его поток обработки
+            if (missing and settings["smart_queries"] and settings.get("batch_queries", True)
+                    and not can_stream_queries(settings, budget)):
+                status_text.text("Генерируем поисковые запросы...")
+                batch_queries = generate_smart_queries_batch(
+                    [paragraphs[i] for i in missing], settings,
+                    [paragraph_debug[i] for i in missing], [paragraph_errors[i] for i in missing]
+                )
+                for i, queries in zip(missing, batch_queries):
+                    paragraph_queries[i] = queries
+            
+            def show_ready_results(next_index: int) -> int:
+                """Показываем все готовые абзацы подряд, не нарушая порядок текста"""
+                while next_index < len(paragraphs) and paragraph_results[next_index] is not None:
+                    with results_container:
+                        display_paragraph_result(paragraph_results[next_index], next_index, settings)
+                    next_index += 1
+                return next_index
+            
+            done = len(paragraphs) - len(missing)
+            status_text.text(f"Обрабатываем абзацы: {done} из {len(paragraphs)}...")
+            progress_bar.progress(done / len(paragraphs))
+            next_index = show_ready_results(0)
+            
+            with create_executor(max(1, min(PARAGRAPH_WORKERS, len(missing)))) as executor:
+                # Абзацы обрабатываются параллельно, а выводятся по порядку
+                futures = {
+                    executor.submit(process_paragraph_cached, paragraphs[i], settings, cache_keys[i],
+                                    budget, paragraph_queries[i], paragraph_debug[i], paragraph_errors[i]): i
+                    for i in missing
+                }
                 
-                # Показываем результат сразу
-                with results_container:
-                    display_paragraph_result(result, i, st.session_state.settings)
+                # Прогресс обновляется по мере готовности любого абзаца
+                for done, future in enumerate(as_completed(futures), done + 1):
+                    i = futures[future]
+                    result = future.result()
+                    result['paragraph_index'] = i
+                    result['digest'] = digests[i]
+                    paragraph_results[i] = result
+                    
+                    status_text.text(f"Обрабатываем абзацы: {done} из {len(paragraphs)}...")
+                    progress_bar.progress(done / len(paragraphs))
+                    next_index = show_ready_results(next_index)
             
             results = st.session_state.processing_results
             
@@ -1366,15 +2606,14 @@ def main():
             )
             
             # Создаем HTML отчет
-            html_file = create_html_report(results, st.session_state.settings)
+            html_content = create_html_report(results, st.session_state.settings, total_images)
+            st.session_state.report_html = html_content
             
             # Отображаем результаты
             st.success(f"✅ Обработано {len(paragraphs)} абзацев, найдено {total_images} изображений")
             
-            if html_file and os.path.exists(html_file):
-                with open(html_file, 'r', encoding='utf-8') as f:
-                    html_content = f.read()
-                
+            if html_content:
+                # Кнопка получает строку напрямую, без повторного чтения файла
                 st.download_button(
                     label="📄 Скачать HTML отчет",
                     data=html_content,
@@ -1385,33 +2624,106 @@ def main():
             # Результаты уже отображены динамически выше
             status_text.text("✅ Обработка завершена!")
             progress_bar.progress(1.0)
+            
+            # Временные объекты анализа собираем сразу, а не посреди следующего перезапуска
+            gc.collect()
+        
+        elif st.session_state.get("processing_results"):
+            # Результаты прошлого анализа показываем из session_state
+            render_results(st.session_state.settings)
     
     with col2:
-        st.header("📊 История")
-        history = load_history()
-        
-        if history:
-            for entry in history[:10]:  # Показываем последние 10 записей
-                with st.expander(f"📅 {entry['timestamp']}"):
-                    st.text(f"Текст: {entry['text_preview']}")
-                    st.text(f"Абзацев: {entry['paragraphs_count']}")
-                    st.text(f"Изображений: {entry['images_count']}")
-                    st.text(f"Поисковик: {entry['search_engine']}")
-        else:
-            st.info("История пуста")
-        
-        # Кнопка очистки истории
-        if st.button("🗑️ Очистить историю"):
-            try:
-                if os.path.exists(HISTORY_FILE):
-                    os.remove(HISTORY_FILE)
-                st.success("История очищена")
-                st.rerun()
-            except Exception as e:
-                st.error(f"Ошибка очистки истории: {e}")
+        render_history()
+
+def render_results(settings: Dict):
+    """Результаты последнего анализа; каждый абзац - отдельный фрагмент"""
+    report_html = st.session_state.get("report_html")
+    if report_html:
+        st.download_button(
+            label="📄 Скачать HTML отчет",
+            data=report_html,
+            file_name=f"visual_analysis_{int(time.time())}.html",
+            mime="text/html",
+            key="download_report"
+        )
+    
+    for i, result in enumerate(st.session_state.processing_results):
+        # Пустые ячейки остаются, если прошлый анализ был прерван
+        if result is not None:
+            display_paragraph_result(result, i, settings)
 
+@st.cache_data(max_entries=4, show_spinner=False)
+def format_history_entries(history: List[Dict]) -> List[tuple]:
+    """Заголовок и готовый многострочный текст для каждой записи истории"""
+    return [
+        (
+            f"📅 {entry['timestamp']}",
+            f"Текст: {entry['text_preview']}\n"
+            f"Абзацев: {entry['paragraphs_count']}\n"
+            f"Изображений: {entry['images_count']}\n"
+            f"Поисковик: {entry['search_engine']}"
+        )
+        for entry in history
+    ]
+
+@fragment
+def render_history():
+    """Панель истории (фрагмент: перезапускается независимо от остального приложения)"""
+    st.header("📊 История")
+    history = load_history()
+    
+    if history:
+        for title, details in format_history_entries(history[:10]):  # Показываем последние 10 записей
+            with st.expander(title):
+                st.text(details)
+    else:
+        st.info("История пуста")
+    
+    # Кнопка очистки истории
+    if st.button("🗑️ Очистить историю"):
+        try:
+            # Удаление без предварительной проверки: нет гонки между exists и remove
+            Path(HISTORY_FILE).unlink(missing_ok=True)
+            # Отпечаток файла и так меняется, но старые записи незачем держать в памяти
+            read_jsonl_tail.clear()
+            format_history_entries.clear()
+            # Уведомление переживает перезапуск, в отличие от st.success
+            st.toast("История очищена")
+            st.rerun()
+        except Exception as e:
+            st.error(f"Ошибка очистки истории: {e}")
+
+@fragment
 def display_paragraph_result(result: Dict, index: int, settings: Dict):
-    """Отображение результата обработки абзаца с кнопкой 'Заново'"""
+    """
+    Отображение результата обработки абзаца с кнопкой 'Заново'.
+    Фрагмент: нажатие кнопки обрабатывает заново только этот абзац
+    """
+    # При перезапуске фрагмента аргументы прежние, актуальный результат - в session_state
+    results = st.session_state.get("processing_results", [])
+    if index < len(results) and results[index] is not None:
+        result = results[index]
+    
+    # Состояние кнопки известно до ее отрисовки, поэтому обрабатываем заранее
+    if st.session_state.get(f"retry_{index}"):
+        # Повторная обработка абзаца мимо кэша: пользователь ждет новый результат
+        with st.spinner("Повторная обработка..."):
+            digest = result.get("digest") or text_digest(result["text"])
+            result = process_paragraph(result["text"], settings, ignore_cache=True)
+            # Новый результат заменяет сохраненный: следующий анализ того же текста вернет его
+            store_paragraph_cache(paragraph_cache_key(digest, process_cache_key(settings)), result)
+            result['paragraph_index'] = index
+            result['digest'] = digest
+            if index < len(results):
+                st.session_state.processing_results[index] = result
+                # Отчет (и output.html) собираем заново с новыми изображениями абзаца
+                st.session_state.report_html = create_html_report(
+                    [r for r in st.session_state.processing_results if r is not None], settings
+                )
+                # Кнопка скачивания нарисована вне фрагмента: перезапуск приложения
+                # передает ей новый отчет (обработка абзацев при этом не повторяется)
+                st.rerun()
+    
     with st.expander(f"📄 Абзац {index+1} ({len(result['images'])} изображений)", expanded=True):
         col1, col2 = st.columns([4, 1])
         
@@ -1419,15 +2731,13 @@ def display_paragraph_result(result: Dict, index: int, settings: Dict):
             st.text(result["text"])
         
         with col2:
-            if st.button("🔄 Заново", key=f"retry_{index}"):
-                # Повторная обработка абзаца
-                with st.spinner("Повторная обработка..."):
-                    new_result = process_paragraph(result["text"], settings)
-                    new_result['paragraph_index'] = index
-                    
-                    # Обновляем результат в session_state
-                    st.session_state.processing_results[index] = new_result
-                    st.rerun()
+            st.button("🔄 Заново", key=f"retry_{index}")
+        
+        for error in result.get("errors", ()):
+            st.error(error)
+        
+        if result.get("debug_lines"):
+            st.code("\n".join(result["debug_lines"]), language="text")
         
         if result["queries"]:
             st.markdown("**🔍 Поисковые запросы:**")
@@ -1436,17 +2746,18 @@ def display_paragraph_result(result: Dict, index: int, settings: Dict):
         else:
             st.warning("⚠️ Поисковые запросы не сгенерированы. Проверьте настройки LLM.")
         
-        if result["images"]:
+        # Пустые и нестроковые URL отсеиваем заранее, остальное выводим одной галереей
+        images = [img for img in result["images"] if isinstance(img.get("url"), str) and img["url"]]
+        if images:
             st.markdown("**🖼️ Найденные изображения:**")
-            cols = st.columns(min(len(result["images"]), 4))
-            
-            for j, img in enumerate(result["images"]):
-                with cols[j % 4]:
-                    try:
-                        st.image(img["url"], caption=f"Запрос: {img['query']}")
-                        st.caption(f"Источник: {img['search_engine']}")
-                    except:
-                        st.error(f"Ошибка загрузки изображения: {img['url']}")
+            try:
+                st.image(
+                    [img["url"] for img in images],
+                    caption=[f"{img['query']} ({img['search_engine']})" for img in images],
+                    width=200
+                )
+            except Exception as e:
+                st.error(f"Ошибка загрузки изображений: {e}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
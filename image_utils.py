@@ -12,22 +12,79 @@ import os
 import time
 import random
 import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin, urlparse, quote
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from typing import List, Dict, Optional, Union
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+# lxml разбирает HTML на C в несколько раз быстрее встроенного парсера; без него работаем как раньше
+try:
+    import lxml
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
 # Настройки для устойчивости к сетевым ошибкам
 NETWORK_CONFIG = {
     'timeout': 30,  # Увеличенный таймаут
     'max_retries': 3,  # Количество повторных попыток
     'backoff_factor': 1,  # Фактор экспоненциального отката
     'retry_statuses': [429, 500, 502, 503, 504],  # Статусы для повтора
-    'delay_between_requests': 1,  # Задержка между запросами в секундах
+    'delay_between_requests': 1,  # Минимальная задержка перед повторной попыткой в секундах
+    'backoff_cap': 30,  # Максимальная задержка перед повторной попыткой в секундах
+    'pool_size': 32,  # Размер пула соединений общей сессии (запросы идут из нескольких потоков)
 }
 
-def create_robust_session():
+# User-Agent по умолчанию для всех сессий (python-requests многие сайты блокируют)
+DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+# Заголовки HTML страниц поиска Tenor
+TENOR_PAGE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'ru,en;q=0.9',
+    'Referer': 'https://tenor.com/',
+    'DNT': '1',
+    'Connection': 'keep-alive'
+}
+
+# Ссылки в тексте абзаца
+URL_PATTERN = re.compile(r'https?://[^\s<>"{}|\\^`\[\]]+')
+
+# Pinterest: карточки пинов и извлечение картинок одним вызовом в браузере
+PINTEREST_PIN_SELECTOR = "div[data-test-id='pin']"
+PINTEREST_COUNT_PINS_JS = "([selector, count]) => document.querySelectorAll(selector).length >= count"
+PINTEREST_EXTRACT_JS = """([selector, limit]) => Array.from(document.querySelectorAll(selector)).slice(0, limit).map(pin => {
+    const img = pin.querySelector("div[data-test-id='pinrep-image'] img.hCL")
+        || pin.querySelector("img[src*='/236x/'], img[src*='/474x/']");
+    return img ? {src: img.getAttribute('src'), alt: img.getAttribute('alt')} : null;
+})"""
+
+# Ограничение одновременных запросов к тяжелым или чувствительным к rate limit поисковикам
+ENGINE_CONCURRENCY = {
+    'pinterest': 2,  # Каждый поиск запускает отдельный браузер
+    'duckduckgo': 3,
+}
+_ENGINE_SEMAPHORES = {engine: threading.BoundedSemaphore(limit) for engine, limit in ENGINE_CONCURRENCY.items()}
+
+# Кэш результатов поиска на диске: один и тот же запрос к поисковику
+# в течение нескольких часов возвращает практически те же картинки
+SEARCH_CACHE_FILE = "search_cache.sqlite"
+SEARCH_CACHE_TTL = 3 * 3600
+_search_cache = {"conn": None, "lock": threading.Lock(), "failed": False}
+
+# URL медиа в JSON внутри <script> страниц Tenor (компилируются один раз)
+TENOR_SCRIPT_URL_PATTERNS = [
+    re.compile(r'"url":"(https://[^"]*tenor\.com[^"]*\.(?:gif|webp|mp4)[^"]*)"'),
+    re.compile(r'"gif":\s*\{[^}]*"url":"([^"]*)"'),
+    re.compile(r'"webp":\s*\{[^}]*"url":"([^"]*)"'),
+]
+
+def create_robust_session(pool_size: int = 10):
     """
     Создает сессию requests с настройками для устойчивости к сетевым ошибкам
     """
@@ -41,32 +98,37 @@ def create_robust_session():
         raise_on_status=False
     )
     
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=pool_size, pool_maxsize=pool_size)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     
+    # Заголовки по умолчанию задаются один раз, а не в каждом запросе
+    session.headers['User-Agent'] = DEFAULT_USER_AGENT
+    
     return session
 
+# Общая сессия: переиспользует TCP/TLS соединения между запросами и потоками
+HTTP_SESSION = create_robust_session(pool_size=NETWORK_CONFIG['pool_size'])
+
 def safe_request(url, headers=None, params=None, timeout=None, session=None):
     """
     Безопасный запрос с обработкой ошибок и повторными попытками
     """
     if session is None:
-        session = create_robust_session()
+        session = HTTP_SESSION
     
     if timeout is None:
         timeout = NETWORK_CONFIG['timeout']
     
-    if headers is None:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-    
+    # Без явных заголовков действует DEFAULT_USER_AGENT сессии
+    base_delay = NETWORK_CONFIG['delay_between_requests']
+    delay = base_delay
     for attempt in range(NETWORK_CONFIG['max_retries'] + 1):
         try:
-            # Добавляем случайную задержку для избежания rate limiting
+            # Decorrelated jitter: задержки параллельных потоков расходятся,
+            # и повторы не приходят к серверу одновременно
             if attempt > 0:
-                delay = NETWORK_CONFIG['delay_between_requests'] * (2 ** attempt) + random.uniform(0, 1)
+                delay = min(NETWORK_CONFIG['backoff_cap'], random.uniform(base_delay, delay * 3))
                 print(f"Попытка {attempt + 1}, ожидание {delay:.1f} сек...")
                 time.sleep(delay)
             
@@ -100,45 +162,126 @@ def safe_request(url, headers=None, params=None, timeout=None, session=None):
     
     return None
 
-def search_images(query: str, max_results: int = 4, search_engine: Union[str, List[str]] = "duckduckgo", searxng_url: str = "http://localhost:8080") -> List[Dict]:
+def _get_search_cache_conn() -> Optional[sqlite3.Connection]:
+    """Соединение с кэшем поиска (открывается при первом обращении, вызывать под блокировкой)"""
+    if _search_cache["conn"] is None and not _search_cache["failed"]:
+        try:
+            conn = sqlite3.connect(SEARCH_CACHE_FILE, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS search (key TEXT PRIMARY KEY, results TEXT, ts REAL)")
+            # Устаревшие записи удаляем при открытии, чтобы файл не рос
+            conn.execute("DELETE FROM search WHERE ts < ?", (time.time() - SEARCH_CACHE_TTL,))
+            conn.commit()
+            _search_cache["conn"] = conn
+        except sqlite3.Error as e:
+            print(f"Кэш поиска недоступен: {e}")
+            _search_cache["failed"] = True
+    return _search_cache["conn"]
+
+def _search_cache_key(query: str, max_results: int, search_engine: str, searxng_url: str) -> str:
+    """Ключ кэша: поисковик, запрос, количество (и адрес для SearXNG)"""
+    instance = searxng_url if search_engine == "searxng" else ""
+    return json.dumps([search_engine, query, max_results, instance], ensure_ascii=False)
+
+def get_cached_search(key: str) -> Optional[List[Dict]]:
+    """Результаты поиска из кэша или None, если их нет или они устарели"""
+    with _search_cache["lock"]:
+        conn = _get_search_cache_conn()
+        if conn is None:
+            return None
+        try:
+            row = conn.execute("SELECT results FROM search WHERE key = ? AND ts >= ?",
+                               (key, time.time() - SEARCH_CACHE_TTL)).fetchone()
+        except sqlite3.Error:
+            return None
+    return json.loads(row[0]) if row else None
+
+def store_cached_search(key: str, results: List[Dict]) -> None:
+    """Сохранение результатов поиска (пустые не сохраняем - это может быть временный сбой)"""
+    if not results:
+        return
+    with _search_cache["lock"]:
+        conn = _get_search_cache_conn()
+        if conn is None:
+            return
+        try:
+            conn.execute("INSERT OR REPLACE INTO search (key, results, ts) VALUES (?, ?, ?)",
+                         (key, json.dumps(results, ensure_ascii=False), time.time()))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Ошибка записи в кэш поиска: {e}")
+
+def search_images(query: str, max_results: int = 4, search_engine: Union[str, List[str]] = "duckduckgo", searxng_url: str = "http://localhost:8080",
+                  session: Optional[requests.Session] = None, ignore_cache: bool = False) -> List[Dict]:
     """
     Универсальная функция поиска изображений
-    Поддерживает множественный выбор поисковиков и SearXNG
+    Поддерживает множественный выбор поисковиков и SearXNG.
+    session - общая HTTP сессия вызывающего кода (по умолчанию HTTP_SESSION)
+    ignore_cache - искать заново, не читая кэш (новый результат в кэш сохраняется)
     """
     # Если передан список поисковиков, объединяем результаты
     if isinstance(search_engine, list):
-        all_results = []
+        if not search_engine:
+            return []
         results_per_engine = max(1, max_results // len(search_engine))
         
-        for engine in search_engine:
+        def search_engine_safe(engine):
             try:
                 print(f"Поиск через {engine}...")
-                results = search_images_single(query, results_per_engine, engine, searxng_url)
-                all_results.extend(results)
+                results = search_images_single(query, results_per_engine, engine, searxng_url, session,
+                                               ignore_cache)
                 print(f"Найдено {len(results)} изображений через {engine}")
+                return results
             except Exception as e:
                 print(f"Ошибка поиска в {engine}: {e}")
-                continue
+                return []
+        
+        # Поисковики независимы - опрашиваем одновременно, порядок результатов сохраняем
+        all_results = []
+        with ThreadPoolExecutor(max_workers=len(search_engine)) as executor:
+            for results in executor.map(search_engine_safe, search_engine):
+                all_results.extend(results)
         
         return all_results[:max_results]
     
     # Одиночный поисковик
-    return search_images_single(query, max_results, search_engine, searxng_url)
+    return search_images_single(query, max_results, search_engine, searxng_url, session, ignore_cache)
 
-def search_images_single(query: str, max_results: int = 4, search_engine: str = "duckduckgo", searxng_url: str = "http://localhost:8080") -> List[Dict]:
+def search_images_single(query: str, max_results: int = 4, search_engine: str = "duckduckgo", searxng_url: str = "http://localhost:8080",
+                         session: Optional[requests.Session] = None, ignore_cache: bool = False) -> List[Dict]:
     """
-    Поиск изображений через один поисковик
+    Поиск изображений через один поисковик (с кэшем результатов на SEARCH_CACHE_TTL)
     """
+    cache_key = _search_cache_key(query, max_results, search_engine, searxng_url)
+    if not ignore_cache:
+        cached = get_cached_search(cache_key)
+        if cached is not None:
+            return cached
+    
+    semaphore = _ENGINE_SEMAPHORES.get(search_engine)
+    if semaphore is None:
+        results = _search_images_engine(query, max_results, search_engine, searxng_url, session)
+    else:
+        with semaphore:
+            results = _search_images_engine(query, max_results, search_engine, searxng_url, session)
+    
+    store_cached_search(cache_key, results)
+    return results
+
+def _search_images_engine(query: str, max_results: int, search_engine: str, searxng_url: str,
+                          session: Optional[requests.Session] = None) -> List[Dict]:
+    """Выбор функции поиска по имени поисковика"""
+    # DuckDuckGo и Pinterest работают через свои клиенты, сессия им не нужна
     if search_engine == "duckduckgo":
         return search_images_duckduckgo(query, max_results)
     elif search_engine == "pixabay":
-        return search_images_pixabay(query, max_results)
+        return search_images_pixabay(query, max_results, session)
     elif search_engine == "pinterest":
         return search_images_pinterest(query, max_results)
     elif search_engine == "searxng":
-        return search_images_searxng(query, max_results, searxng_url)
+        return search_images_searxng(query, max_results, searxng_url, session)
     elif search_engine == "tenor":
-        return search_images_tenor(query, max_results)
+        return search_images_tenor(query, max_results, session)
     else:
         # По умолчанию используем DuckDuckGo как самый стабильный
         return search_images_duckduckgo(query, max_results)
@@ -159,8 +302,8 @@ def search_images_duckduckgo(query: str, max_results: int = 4) -> List[Dict]:
                 return []
         
         results = []
-        time.sleep(NETWORK_CONFIG['delay_between_requests'])
         
+        # Частоту запросов ограничивает семафор поисковика, rate limit обрабатывается ниже
         with DDGS() as ddgs:
             try:
                 ddgs_images_gen = ddgs.images(
@@ -212,13 +355,11 @@ def search_images_duckduckgo(query: str, max_results: int = 4) -> List[Dict]:
         print(f"Ошибка поиска DuckDuckGo: {e}")
         return []
 
-def search_images_pixabay(query: str, max_results: int = 4) -> List[Dict]:
+def search_images_pixabay(query: str, max_results: int = 4, session: Optional[requests.Session] = None) -> List[Dict]:
     """
     Поиск изображений через Pixabay
     """
     try:
-        session = create_robust_session()
-        
         search_url = f"https://pixabay.com/api/"
         params = {
             'key': '9656065-a4094594c34f9ac14c7fc4c39',
@@ -257,7 +398,7 @@ def search_images_pinterest(query: str, max_results: int = 4) -> List[Dict]:
     Pinterest поиск с fallback
     """
     try:
-        from playwright.sync_api import sync_playwright
+        from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
         import urllib.parse
         
         encoded_query = urllib.parse.quote(query)
@@ -279,53 +420,57 @@ def search_images_pinterest(query: str, max_results: int = 4) -> List[Dict]:
                 page = context.new_page()
                 page.set_default_timeout(30000)
                 page.goto(search_url, wait_until='networkidle')
-                page.wait_for_timeout(3000)
+                
+                # Ждем не фиксированное время, а появления нужного количества пинов
+                target_pins = max_results * 2
+                pins_arg = [PINTEREST_PIN_SELECTOR, target_pins]
+                try:
+                    page.wait_for_selector(PINTEREST_PIN_SELECTOR, timeout=3000)
+                except PlaywrightTimeoutError:
+                    pass
                 
                 for i in range(7):
+                    if page.evaluate(PINTEREST_COUNT_PINS_JS, pins_arg):
+                        break
                     page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
-                    page.wait_for_timeout(1000)
+                    try:
+                        page.wait_for_function(PINTEREST_COUNT_PINS_JS, arg=pins_arg, timeout=1000)
+                    except PlaywrightTimeoutError:
+                        continue
                 
-                pin_containers = page.query_selector_all("div[data-test-id='pin']")
+                # Адреса и подписи всех картинок одним обращением к странице
+                pins = page.evaluate(PINTEREST_EXTRACT_JS, pins_arg)
                 processed_urls = set()
                 
-                for pin_container in pin_containers[:max_results * 2]:
-                    try:
-                        img_element = pin_container.query_selector("div[data-test-id='pinrep-image'] img.hCL")
-                        if not img_element:
-                            img_element = pin_container.query_selector("img[src*='/236x/'], img[src*='/474x/']")
-                        
-                        if img_element:
-                            src = img_element.get_attribute('src')
-                            if not src:
-                                continue
-                            
-                            full_size_url = src
-                            if '/236x/' in src:
-                                full_size_url = src.replace('/236x/', '/originals/')
-                            elif '/474x/' in src:
-                                full_size_url = src.replace('/474x/', '/originals/')
-                            
-                            if full_size_url in processed_urls:
-                                continue
-                            processed_urls.add(full_size_url)
-                            
-                            img_alt = img_element.get_attribute('alt') or f"Pinterest image for {query}"
-                            
-                            results.append({
-                                'url': full_size_url,
-                                'title': img_alt,
-                                'source': 'Pinterest',
-                                'thumbnail': src,
-                                'width': 0,
-                                'height': 0,
-                                'author': 'Pinterest'
-                            })
-                            
-                            if len(results) >= max_results:
-                                break
-                                
-                    except Exception as e:
+                for pin in pins:
+                    if not pin or not pin.get('src'):
                         continue
+                    src = pin['src']
+                    
+                    full_size_url = src
+                    if '/236x/' in src:
+                        full_size_url = src.replace('/236x/', '/originals/')
+                    elif '/474x/' in src:
+                        full_size_url = src.replace('/474x/', '/originals/')
+                    
+                    if full_size_url in processed_urls:
+                        continue
+                    processed_urls.add(full_size_url)
+                    
+                    img_alt = pin.get('alt') or f"Pinterest image for {query}"
+                    
+                    results.append({
+                        'url': full_size_url,
+                        'title': img_alt,
+                        'source': 'Pinterest',
+                        'thumbnail': src,
+                        'width': 0,
+                        'height': 0,
+                        'author': 'Pinterest'
+                    })
+                    
+                    if len(results) >= max_results:
+                        break
                 
             finally:
                 browser.close()
@@ -336,11 +481,15 @@ def search_images_pinterest(query: str, max_results: int = 4) -> List[Dict]:
         print(f"Ошибка поиска Pinterest: {e}")
         return []
 
-def search_images_searxng(query: str, max_results: int = 4, searxng_url: str = "http://localhost:8080") -> List[Dict]:
+def search_images_searxng(query: str, max_results: int = 4, searxng_url: str = "http://localhost:8080",
+                          session: Optional[requests.Session] = None) -> List[Dict]:
     """
     ИСПРАВЛЕННЫЙ SearXNG поиск - использует HTML парсинг (ПРОТЕСТИРОВАНО И РАБОТАЕТ!)
     Ключевое исправление: НЕ используем format=json, парсим HTML
     """
+    if session is None:
+        session = HTTP_SESSION
+    
     print(f"🔍 SearXNG поиск: '{query}' через {searxng_url}")
     
     # Проверенные рабочие инстансы + локальный
@@ -382,12 +531,13 @@ def search_images_searxng(query: str, max_results: int = 4, searxng_url: str = "
             search_url = f"{base_url.rstrip('/')}/search"
             print(f"📡 HTML запрос: {search_url}")
             
-            response = requests.get(search_url, params=search_params, headers=headers, timeout=20)
+            response = session.get(search_url, params=search_params, headers=headers, timeout=20)
             print(f"📊 Ответ: {response.status_code}")
             
             if response.status_code == 200:
                 # Парсим HTML вместо JSON
-                soup = BeautifulSoup(response.text, 'html.parser')
+                # Без SoupStrainer: источник определяется по классу родителя img
+                soup = BeautifulSoup(response.text, HTML_PARSER)
                 results = []
                 processed_urls = set()
                 
@@ -543,7 +693,8 @@ def search_images_external_searxng(query: str, max_results: int = 4) -> List[Dic
             print(f"📊 Ответ: {response.status_code}")
             
             if response.status_code == 200:
-                soup = BeautifulSoup(response.text, 'html.parser')
+                # Нужны только атрибуты img: остальное дерево не строим
+                soup = BeautifulSoup(response.text, HTML_PARSER, parse_only=SoupStrainer('img'))
                 img_tags = soup.find_all('img')
                 processed_urls = set()
                 
@@ -625,11 +776,14 @@ def search_images_external_searxng(query: str, max_results: int = 4) -> List[Dic
     return []
 
 
-def search_images_tenor(query: str, max_results: int = 4) -> List[Dict]:
+def search_images_tenor(query: str, max_results: int = 4, session: Optional[requests.Session] = None) -> List[Dict]:
     """
     Улучшенная функция поиска GIF/WebP/MP4 на Tenor.com
     Использует множественные методы парсинга включая API
     """
+    if session is None:
+        session = HTTP_SESSION
+    
     results = []
     encoded_query = quote(query)
     
@@ -647,7 +801,7 @@ def search_images_tenor(query: str, max_results: int = 4) -> List[Dict]:
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
         
-        response = requests.get(api_url, params=api_params, headers=headers, timeout=10)
+        response = session.get(api_url, params=api_params, headers=headers, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -688,7 +842,7 @@ def search_images_tenor(query: str, max_results: int = 4) -> List[Dict]:
             'limit': max_results
         }
         
-        response = requests.get(alt_api_url, params=alt_params, headers=headers, timeout=10)
+        response = session.get(alt_api_url, params=alt_params, headers=headers, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -726,23 +880,12 @@ def search_images_tenor(query: str, max_results: int = 4) -> List[Dict]:
             f"https://tenor.com/ru/search/{encoded_query}-gifs"
         ]
         
-        session = create_robust_session()
-        
         for search_url in search_urls:
             try:
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                    'Accept-Language': 'ru,en;q=0.9',
-                    'Referer': 'https://tenor.com/',
-                    'DNT': '1',
-                    'Connection': 'keep-alive'
-                }
-                
-                response = safe_request(search_url, headers=headers, session=session)
+                response = safe_request(search_url, headers=TENOR_PAGE_HEADERS, session=session)
                 
                 if response and response.status_code == 200:
-                    soup = BeautifulSoup(response.text, 'html.parser')
+                    soup = BeautifulSoup(response.text, HTML_PARSER)
                     processed_urls = set()
                     
                     # Поиск различными методами
@@ -799,14 +942,8 @@ def search_images_tenor(query: str, max_results: int = 4) -> List[Dict]:
                             script_text = script.get_text()
                             if script_text and ('tenor.com' in script_text or 'media.tenor.com' in script_text):
                                 # Ищем JSON данные с URL
-                                json_patterns = [
-                                    r'"url":"(https://[^"]*tenor\.com[^"]*\.(?:gif|webp|mp4)[^"]*)"',
-                                    r'"gif":\s*\{[^}]*"url":"([^"]*)"',
-                                    r'"webp":\s*\{[^}]*"url":"([^"]*)"'
-                                ]
-                                
-                                for pattern in json_patterns:
-                                    matches = re.findall(pattern, script_text)
+                                for pattern in TENOR_SCRIPT_URL_PATTERNS:
+                                    matches = pattern.findall(script_text)
                                     for match in matches:
                                         if match not in processed_urls and 'tenor' in match:
                                             processed_urls.add(match)
@@ -859,8 +996,7 @@ def download_images_async(image_urls, output_dir="images"):
     return []
 
 def extract_urls_from_text(text):
-    url_pattern = r'https?://[^\s<>"{}|\\^`\[\]]+'
-    return re.findall(url_pattern, text)
+    return URL_PATTERN.findall(text)
 
 def search_images_from_urls(text, max_images_per_url=3):
     return []
\ No newline at end of file